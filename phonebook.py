@@ -1,68 +1,349 @@
-import web, json, re
+import web, json, re, sys, os, csv, zlib, signal, StringIO, threading, time, bisect, traceback
 
-db = web.database(dbn="sqlite", db="phonebook.db")
+# WAL journaling keeps searches running while entries are written, on
+# long-lived connections shared by the server's threads
+db = web.database(dbn="sqlite", db="phonebook.db", profile="performance",
+                  pool=8)
+
+# Statements run by init_schema. Each one must be safe to run again
+# against a database that already has it applied.
+schema = [
+    '''CREATE TABLE IF NOT EXISTS phonebook (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        surname TEXT,
+        firstname TEXT,
+        number TEXT,
+        address TEXT,
+        surname_key TEXT,
+        number_digits TEXT,
+        version INTEGER NOT NULL DEFAULT 1,
+        json TEXT)''',
+    # Entries from the write log: the id each tracking id got, or the
+    # reason its entry could not be added
+    '''CREATE TABLE IF NOT EXISTS ingested (
+        tid INTEGER PRIMARY KEY,
+        entry_id INTEGER,
+        error TEXT)''',
+    ]
+
+# Columns added to phonebook since it was first released, with their types
+added_columns = [
+    ('surname_key', 'TEXT'),
+    ('number_digits', 'TEXT'),
+    ('version', 'INTEGER NOT NULL DEFAULT 1'),
+    ('json', 'TEXT'),
+    ]
+
+# Run by init_schema once any missing derived columns have been added
+indexes = [
+    # Serves case-insensitive surname searches as index lookups or range
+    # scans, already ordered by surname then firstname
+    '''CREATE INDEX IF NOT EXISTS phonebook_surname_firstname
+        ON phonebook (surname COLLATE NOCASE, firstname COLLATE NOCASE)''',
+    '''CREATE INDEX IF NOT EXISTS phonebook_surname_key
+        ON phonebook (surname_key, surname COLLATE NOCASE, firstname COLLATE NOCASE)''',
+    # Serves reverse lookups by exact number or number prefix
+    '''CREATE INDEX IF NOT EXISTS phonebook_number_digits
+        ON phonebook (number_digits)''',
+    ]
+
+# Full-text index over names and addresses, kept in step with phonebook by
+# triggers. FTS5 is preferred; FTS4 is used where SQLite lacks FTS5. FTS4
+# reads the old row from phonebook when removing it, so its delete runs
+# in BEFORE triggers.
+fulltext_schemas = [
+    ('fts5', [
+        '''CREATE VIRTUAL TABLE phonebook_fts USING fts5(
+            firstname, surname, address, content='phonebook', content_rowid='id')''',
+        '''CREATE TRIGGER phonebook_fts_insert AFTER INSERT ON phonebook BEGIN
+            INSERT INTO phonebook_fts(rowid, firstname, surname, address)
+            VALUES (new.id, new.firstname, new.surname, new.address);
+        END''',
+        '''CREATE TRIGGER phonebook_fts_delete AFTER DELETE ON phonebook BEGIN
+            INSERT INTO phonebook_fts(phonebook_fts, rowid, firstname, surname, address)
+            VALUES ('delete', old.id, old.firstname, old.surname, old.address);
+        END''',
+        '''CREATE TRIGGER phonebook_fts_update
+            AFTER UPDATE OF firstname, surname, address ON phonebook BEGIN
+            INSERT INTO phonebook_fts(phonebook_fts, rowid, firstname, surname, address)
+            VALUES ('delete', old.id, old.firstname, old.surname, old.address);
+            INSERT INTO phonebook_fts(rowid, firstname, surname, address)
+            VALUES (new.id, new.firstname, new.surname, new.address);
+        END''',
+        ]),
+    ('fts4', [
+        '''CREATE VIRTUAL TABLE phonebook_fts USING fts4(
+            firstname, surname, address, content="phonebook")''',
+        '''CREATE TRIGGER phonebook_fts_insert AFTER INSERT ON phonebook BEGIN
+            INSERT INTO phonebook_fts(docid, firstname, surname, address)
+            VALUES (new.id, new.firstname, new.surname, new.address);
+        END''',
+        '''CREATE TRIGGER phonebook_fts_delete BEFORE DELETE ON phonebook BEGIN
+            DELETE FROM phonebook_fts WHERE docid = old.id;
+        END''',
+        '''CREATE TRIGGER phonebook_fts_update_before
+            BEFORE UPDATE OF firstname, surname, address ON phonebook BEGIN
+            DELETE FROM phonebook_fts WHERE docid = old.id;
+        END''',
+        '''CREATE TRIGGER phonebook_fts_update_after
+            AFTER UPDATE OF firstname, surname, address ON phonebook BEGIN
+            INSERT INTO phonebook_fts(docid, firstname, surname, address)
+            VALUES (new.id, new.firstname, new.surname, new.address);
+        END''',
+        ]),
+    ]
+
+# Set by init_fulltext to the FTS module backing phonebook_fts
+fulltext_module = None
+
+# Keeps each entry's JSON serialization in the json column, so responses
+# can be assembled from stored fragments instead of encoding every row on
+# every request. Used where SQLite has the JSON functions.
+json_object_sql = '''json_object('id', new.id, 'firstname', new.firstname,
+    'surname', new.surname, 'number', new.number, 'address', new.address)'''
+json_triggers = [
+    '''CREATE TRIGGER IF NOT EXISTS phonebook_json_insert AFTER INSERT ON phonebook BEGIN
+        UPDATE phonebook SET json = %s WHERE id = new.id;
+    END''' % json_object_sql,
+    '''CREATE TRIGGER IF NOT EXISTS phonebook_json_update
+        AFTER UPDATE OF firstname, surname, number, address ON phonebook BEGIN
+        UPDATE phonebook SET json = %s WHERE id = new.id;
+    END''' % json_object_sql,
+    ]
+
+def init_schema(database):
+    '''Creates the phonebook table, columns and indexes that are missing
+    from database'''
+    for statement in schema:
+        database.query(statement)
+    init_columns(database)
+    for statement in indexes:
+        database.query(statement)
+    init_fulltext(database)
+    init_json(database)
+
+def init_columns(database):
+    '''Adds any missing columns to phonebook and fills in derived columns
+    for entries written before the column existed'''
+    columns = [row.name for row in database.query('PRAGMA table_info(phonebook)')]
+    for column, type in added_columns:
+        if column not in columns:
+            database.query('ALTER TABLE phonebook ADD COLUMN %s %s' % (column, type))
+    for column, field, derive in derived_columns:
+        rows = database.query('''SELECT id, %s AS value FROM phonebook
+                                 WHERE %s IS NULL AND %s IS NOT NULL'''
+                              % (field, column, field)).list()
+        with database.transaction():
+            for row in rows:
+                database.update('phonebook', where='id=$id', vars={'id':row.id},
+                                **{column:derive(row.value)})
+
+def init_fulltext(database):
+    '''Creates the phonebook_fts full-text index and its triggers if missing,
+    indexing any existing entries'''
+    global fulltext_module
+    existing = database.query("SELECT sql FROM sqlite_master WHERE name='phonebook_fts'").list()
+    if existing:
+        fulltext_module = re.search('USING (fts[0-9])', existing[0].sql, re.I).group(1).lower()
+        return
+
+    for module, statements in fulltext_schemas:
+        try:
+            database.query(statements[0])
+        except database.db_module.OperationalError:
+            # This FTS module isn't compiled into SQLite, try the next one
+            continue
+        for statement in statements[1:]:
+            database.query(statement)
+        database.query("INSERT INTO phonebook_fts(phonebook_fts) VALUES('rebuild')")
+        fulltext_module = module
+        return
+
+def init_json(database):
+    '''Creates the triggers that maintain phonebook.json and fills it in
+    for entries that lack it. Without SQLite's JSON functions the column
+    stays empty and entries are encoded per request instead.'''
+    try:
+        database.query("SELECT json_object('id', 1)")
+    except database.db_module.OperationalError:
+        return
+    for statement in json_triggers:
+        database.query(statement)
+    database.query('UPDATE phonebook SET json = %s WHERE json IS NULL'
+                   % json_object_sql.replace('new.', ''))
+
+# Letter groups that share a Soundex digit
+soundex_digits = {}
+for digit, letters in [('1', 'BFPV'), ('2', 'CGJKQSXZ'), ('3', 'DT'),
+                       ('4', 'L'), ('5', 'MN'), ('6', 'R')]:
+    for letter in letters:
+        soundex_digits[letter] = digit
+
+def soundex(name):
+    '''Returns the American Soundex code for name, e.g. Smith and Smyth both
+    give S530. Returns None if name is None or has no ASCII letters.'''
+    if name is None:
+        return None
+    letters = [c for c in web.safeunicode(name).upper() if u'A' <= c <= u'Z']
+    if not letters:
+        return None
+    code = letters[0]
+    last = soundex_digits.get(letters[0])
+    for letter in letters[1:]:
+        digit = soundex_digits.get(letter)
+        if digit and digit != last:
+            code += digit
+        # H and W don't separate letters with the same digit; vowels do
+        if letter not in 'HW':
+            last = digit
+    return (code + '000')[:4]
+
+def number_digits(number):
+    '''Returns number with everything but the digits removed'''
+    return re.sub('[^0-9]', '', number)
+
+# Columns computed from an entry's fields on every write, so that searches
+# on them are index lookups: (column, source field, function)
+derived_columns = [
+    ('surname_key', 'surname', soundex),
+    ('number_digits', 'number', number_digits),
+    ]
+
+def derived_fields(data):
+    '''Returns the derived column values for the fields present in data'''
+    values = {}
+    for column, field, derive in derived_columns:
+        if field in data:
+            values[column] = derive(data[field])
+    return values
 
 urls = ("/", "Phonebook",
+        "/bulk", "BulkImport",
+        "/batch", "Batch",
+        "/export", "Export",
+        "/search", "FullTextSearch",
+        "/_stats", "Stats",
+        "/pending/([0-9]+)", "Pending",
+        "/number/([0-9]+\*?)", "NumberSearch",
         "/([0-9]+)", "Entry",
         "/([^0-9]+)", "Search")
 app = web.application(urls, globals())
    
+# Page size used when listing without ?limit=, and the most a client may ask for
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Rows read per query when streaming the whole phonebook
+STREAM_BATCH_SIZE = 500
+# Rows inserted per transaction by bulk import
+BULK_BATCH_SIZE = 1000
+# Most rejected rows reported individually in a bulk import response
+MAX_BULK_ERRORS = 1000
+# Most operations accepted in one batch request
+MAX_BATCH_OPERATIONS = 10000
+# Most ids in one "WHERE id IN (...)" list
+MAX_IN_LIST = 500
+# Range of SQLite integers, and so of entry ids
+MIN_ENTRY_ID, MAX_ENTRY_ID = -2**63, 2**63 - 1
+# Most surname search responses kept in memory
+SEARCH_CACHE_SIZE = 1000
+# Most single entries kept in memory for GET /<id>
+ENTRY_CACHE_SIZE = 10000
+# Most listing pages kept in memory
+PAGE_CACHE_SIZE = 100
+# Seconds to wait before retrying entries from the write log that failed to insert
+WRITE_LOG_RETRY_DELAY = 1
+# Bytes of added entries at the front of the write log before it is
+# rewritten without them
+WRITE_LOG_COMPACT_SIZE = 1 << 20
+# Most recent tracking ids whose outcome /pending/<tid> remembers
+MAX_TRACKED_TIDS = 100000
+
+# Fields of a phonebook entry in request data
+entry_required_attrs = ['firstname','surname','number']
+entry_attrs = entry_required_attrs + ['address']
+
 class Phonebook:
-    
+    # POST hands entries to the write log when the client prefers respond-async
+    writes_behind = True
+
     def GET(self):
-        '''Returns all entries in phonebook'''
+        '''Returns one page of entries in phonebook, ordered by id.
+        Use ?limit=N for the page size and ?after=<id> to continue from the
+        last id of the previous page. A Link header points at the next page.
+        With ?stream=1 every entry is returned, streamed in chunks.'''
         
-        results = []
-        q = db.query("SELECT id, firstname, surname, number, address FROM phonebook")
-        for row in q:
-            results.append({'id':row.id,
-                            'firstname':row.firstname,
-                            'surname':row.surname,
-                            'number':row.number,
-                            'address':row.address})
-        json_response = json.dumps(results)
-        return json_response
+        params = web.input(limit=None, after=None, stream=None)
+        limit = parse_int(params.limit, DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE, 'invalid_limit')
+        after = parse_int(params.after, 0, 0, None, 'invalid_cursor')
+
+        # Sets the ETag, or raises 304 Not Modified if the client has it
+        web.modified(etag=data_etag())
+
+        if params.stream in ('1', 'true'):
+            # Generator result: wsgifunc sends each chunk as it is produced
+            return json_array_chunks(entry_batches(after))
+
+        response, last = page_response(after, limit)
+        if last is not None:
+            web.header('Link', '<%s/?limit=%d&after=%d>; rel="next"'
+                       % (web.ctx.homepath, limit, last))
+        return response
 
 
     def POST(self):
-        '''Add entry to phonebook with firstname, surname, number, and optional address'''
+        '''Add entry to phonebook with firstname, surname, number, and optional address.
+        With Prefer: respond-async and a write log, the entry is added later
+        and the response points at /pending/<tid> to follow it.'''
         
-        required_attrs = ['firstname','surname','number']
-        optional_attrs = ['address']
-        all_attrs = required_attrs + optional_attrs
-
         data = load_json(web.data())
 
         # Checks all required attributes are present
         # Checks there are no unrecognized fields
         # Validates input
         # Raises 400 Bad request if not valid
-        validate_fields(data, required_attrs, all_attrs)
+        validate_fields(data, entry_required_attrs, entry_attrs)
 
-        fn = data['firstname']
-        sn = data['surname']                
-        nm = data['number']
-        # Check to see whether address is present, or None if not
-        addr = 'address' in data.keys() and data['address'] or None       
-        
-        row_id = db.insert('phonebook',
-                      seqname='id',
-                      firstname=fn,
-                      surname=sn,
-                      number=nm,
-                      address=addr)
+        if write_log is not None and respond_async():
+            tid = write_log.append(data)
+            web.header('Preference-Applied', 'respond-async')
+            # Raised, as a returned status would have no body
+            raise web.accepted(json.dumps({'tid':tid}),
+                                headers={'Location':'/pending/%d'%tid})
+
+        row_id = db.insert('phonebook', seqname='id', **entry_row(data))
+        entries_changed(ids=[row_id], surnames=[data['surname']])
         
         # Return 201 Created
         return web.created(headers={'Location':'/%d'%row_id})
 
 class Entry:
+    def GET(self, id):
+        '''Returns the entry with this id as JSON. The ETag is the entry
+        version, for use in If-None-Match or If-Match.'''
+
+        entry_id = parse_entry_id(id)
+        cached = entry_cache.get(entry_id)
+        if cached is None:
+            generation = entry_cache.generation
+            if memory_index is not None:
+                rows = filter(None, [memory_index.get(entry_id)])
+            else:
+                rows = db.query('''SELECT id, firstname, surname, number, address, version
+                                      FROM phonebook WHERE id=$id''', vars={'id':entry_id}).list()
+            if not rows:
+                raise web.notfound(response_strings['not_found'] % id)
+            cached = (entry_dict(rows[0]), rows[0].version)
+            entry_cache.put(entry_id, cached, generation)
+
+        entry, version = cached
+        web.modified(etag=str(version))
+        return json.dumps(entry)
+
     def PUT(self, id):
         '''Update an existing entry in the phonebook. URI must match /<id>
-        of an existing entry'''
+        of an existing entry. With an If-Match header, the entry is only
+        updated if its version matches.'''
 
-        if not entry_exists(id):
-            raise web.notfound("No matching phonebook entry with id %s" % id)
-        
         required_attrs = []
         optional_attrs = ['firstname','surname','number','address']
         all_attrs = required_attrs + optional_attrs
@@ -79,70 +360,1384 @@ class Entry:
         # Raises 400 Bad request if not valid
         validate_fields(data, required_attrs, all_attrs)
 
-        # feed in data dict
-        res = db.update('phonebook', where="id=$id",
-                        vars={'id':id},
+        entry_id = parse_entry_id(id)
+        surnames = [data[k] for k in ['surname'] if k in data]
+        fields = dict(data)
+        # feed in data dict, plus columns derived from it
+        data.update(derived_fields(data))
+        data['version'] = web.SQLLiteral('version + 1')
+        where, vars = entry_clause(entry_id)
+
+        cached = entry_cache.get(entry_id)
+        if cached is not None:
+            # Only write if the entry is still at the cached version. Then
+            # the cached entry with these fields is exactly the new entry.
+            res = db.update('phonebook', where=where + " AND version=$cached_version",
+                            vars=dict(vars, cached_version=cached[1]),
+                            **data)
+            if res:
+                new = (dict(cached[0], **fields), cached[1] + 1)
+                entries_changed(ids=[entry_id], surnames=surnames,
+                                replaced={entry_id:(cached, new)})
+                return web.nocontent()
+            # Changed behind the cache's back, so the cached entry is stale
+            entry_cache.pop(entry_id)
+
+        # The affected row count tells us whether the entry exists,
+        # so there is no separate existence check
+        res = db.update('phonebook', where=where,
+                        vars=vars,
                         **data)
+        if not res:
+            write_failed(entry_id)
+        entries_changed(ids=[entry_id], surnames=surnames)
         return web.nocontent()
 
     def DELETE(self, id):
         '''Remove an existing entry in the phonebook. URI must match /<id>
-        of an existing entry'''
-
-        if not entry_exists(id):
-            raise web.notfound("No matching phonebook entry with id %s" % id)
+        of an existing entry. With an If-Match header, the entry is only
+        removed if its version matches.'''
 
-        db.delete('phonebook', where="id=$id",
-                  vars={'id':id})
+        entry_id = parse_entry_id(id)
+        where, vars = entry_clause(entry_id)
+        res = db.delete('phonebook', where=where,
+                  vars=vars)
+        if not res:
+            write_failed(entry_id)
+        entries_changed(ids=[entry_id])
         return web.nocontent()
 
 class Search:
     def GET(self, surname):
-        '''Search the phonebook by surname. Returns JSON list of results'''
-
-        results = []
-        q = db.query('''SELECT id, firstname, surname, number, address
-                              FROM phonebook WHERE surname=$surname''',
-                           vars={'surname':surname})
-        for row in q:
-            results.append({'id':row.id,
-                            'firstname':row.firstname,
-                            'surname':row.surname,
-                            'number':row.number,
-                            'address':row.address})
+        '''Search the phonebook by surname, ignoring case. A trailing * (/Mou*)
+        or ?match=prefix finds surnames starting with the given text, and
+        ?match=phonetic finds surnames that sound alike (Smith, Smyth).
+        Returns JSON list of results'''
+
+        params = web.input(match=None)
+        match = params.match or 'exact'
+        if surname.endswith('*'):
+            surname = surname[:-1]
+            match = 'prefix'
+
+        where, vars = surname_clause(match, surname)
+        web.modified(etag=data_etag())
+        return search_response(match, surname, where, vars)
+
+class BulkImport:
+    # Inserts in batches, each committed as it is written, rather than
+    # holding one transaction open for the whole upload
+    transactional = False
+
+    def POST(self):
+        '''Add many entries at once. The request body is streamed and is either
+        NDJSON (one JSON entry per line) or, with Content-Type text/csv, CSV
+        with a header row naming the fields. Valid rows are inserted in
+        batches; invalid rows are skipped and reported by line number.'''
+
+        content_type = web.ctx.env.get('CONTENT_TYPE', '').split(';')[0].strip().lower()
+        if content_type == 'text/csv':
+            records = csv_records(request_lines())
+        else:
+            records = ndjson_records(request_lines())
+
+        inserted, rejected, errors = 0, 0, []
+        batch = []
+        for line, data, error in records:
+            if error is None:
+                try:
+                    check_fields(data, entry_required_attrs, entry_attrs)
+                except ValueError, e:
+                    error = str(e)
+            if error is not None:
+                rejected += 1
+                if len(errors) < MAX_BULK_ERRORS:
+                    errors.append({'line':line, 'error':error})
+                continue
+
+            batch.append(data)
+            if len(batch) >= BULK_BATCH_SIZE:
+                inserted += len(insert_entries(batch))
+                batch = []
+        if batch:
+            inserted += len(insert_entries(batch))
+
+        return json.dumps({'inserted':inserted, 'rejected':rejected, 'errors':errors})
+
+class Batch:
+    def POST(self):
+        '''Apply a JSON list of update and delete operations in one transaction,
+        e.g. [{"op":"update", "id":3, "data":{"number":"0123456"}},
+              {"op":"delete", "id":4}].
+        Returns a JSON list with the status of each operation, in order.'''
+
+        operations = load_json(web.data())
+        if not isinstance(operations, list):
+            raise web.badrequest(response_strings['invalid_batch'])
+        if len(operations) > MAX_BATCH_OPERATIONS:
+            raise web.badrequest(response_strings['batch_too_large'])
+
+        results = [check_operation(op) for op in operations]
+
+        # Each entry may appear in only one operation, so grouping the
+        # operations below can't change their outcome
+        seen = set()
+        for op, result in zip(operations, results):
+            if result['status'] is None:
+                if op['id'] in seen:
+                    result['status'] = 400
+                    result['error'] = response_strings['duplicate_operation']
+                seen.add(op['id'])
+
+        with db.transaction():
+            existing = set()
+            # Ids SQLite can't hold are never found
+            in_range = [id for id in seen if MIN_ENTRY_ID <= id <= MAX_ENTRY_ID]
+            for ids in web.group(in_range, MAX_IN_LIST):
+                existing.update([row.id for row in
+                    db.query("SELECT id FROM phonebook WHERE id IN $ids", vars={'ids':ids})])
+
+            deletes = []
+            # Updates setting the same values share one statement
+            updates = {}
+            for op, result in zip(operations, results):
+                if result['status'] is not None:
+                    continue
+                if op['id'] not in existing:
+                    result['status'] = 404
+                    result['error'] = response_strings['not_found'] % op['id']
+                    continue
+                result['status'] = 204
+                if op['op'] == 'delete':
+                    deletes.append(op['id'])
+                else:
+                    key = json.dumps(op['data'], sort_keys=True)
+                    updates.setdefault(key, (op['data'], []))[1].append(op['id'])
+
+            for ids in web.group(deletes, MAX_IN_LIST):
+                db.delete('phonebook', where="id IN $ids", vars={'ids':ids})
+            for data, update_ids in updates.values():
+                values = dict(data, **derived_fields(data))
+                values['version'] = web.SQLLiteral('version + 1')
+                for ids in web.group(update_ids, MAX_IN_LIST):
+                    db.update('phonebook', where="id IN $ids", vars={'ids':ids}, **values)
+
+        entries_changed(ids=[r['id'] for r in results if r['status'] == 204],
+                        surnames=[data['surname'] for data, update_ids in updates.values()
+                                  if 'surname' in data])
         return json.dumps(results)
 
+class Export:
+    def GET(self):
+        '''Export every entry, one per line, as NDJSON or, with ?format=csv,
+        as CSV with a header row. Streamed straight from the database, and
+        gzip-compressed on the fly when the client accepts gzip.'''
+
+        params = web.input(format='ndjson')
+        if params.format == 'ndjson':
+            web.header('Content-Type', 'application/x-ndjson')
+            chunks = ndjson_chunks(entry_batches())
+        elif params.format == 'csv':
+            web.header('Content-Type', 'text/csv; charset=utf-8')
+            chunks = csv_chunks(entry_batches())
+        else:
+            raise web.badrequest(response_strings['invalid_format'])
+
+        web.header('Vary', 'Accept-Encoding')
+        if accepts_gzip():
+            web.header('Content-Encoding', 'gzip')
+            chunks = gzip_chunks(chunks)
+        return chunks
+
+class Stats:
+    def GET(self):
+        '''Returns JSON counters for the in-memory caches'''
+        return json.dumps({'search_cache':search_cache.stats(),
+                           'entry_cache':entry_cache.stats(),
+                           'page_cache':page_cache.stats(),
+                           'read_flight':read_flight.stats(),
+                           'memory_index':memory_index and memory_index.stats(),
+                           'write_log':write_log and write_log.stats()})
+
+class Pending:
+    def GET(self, tid):
+        '''Follows an entry accepted for adding later. Redirects to the entry
+        once it has been added, returns 202 Accepted until then, and the
+        reason if it could not be added.'''
+        tid = int(tid)
+        # Read first: tracking ids up to it are all in ingested unless
+        # they were pruned
+        drained_tid = write_log and write_log.drained_tid
+        rows = []
+        if tid <= MAX_ENTRY_ID:
+            rows = db.select('ingested', where='tid=$tid', vars={'tid':tid}).list()
+        if rows and rows[0].entry_id is None:
+            return json.dumps({'tid':tid, 'error':rows[0].error})
+        if rows:
+            raise web.seeother('/%d' % rows[0].entry_id)
+        if write_log is None or tid > write_log.last_tid or tid <= drained_tid:
+            raise web.notfound(response_strings['pending_not_found'] % tid)
+        raise web.accepted(json.dumps({'tid':tid}))
+
+class FullTextSearch:
+    def GET(self):
+        '''Search names and addresses for all the words in ?q=, best matches
+        first. Returns JSON list of at most ?limit= results'''
+
+        params = web.input(q='', limit=None)
+        limit = parse_int(params.limit, DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE, 'invalid_limit')
+        # Quote each word so user input can't form FTS query syntax
+        words = re.findall(r'\w+', web.safeunicode(params.q), re.UNICODE)
+        if not words:
+            raise web.badrequest(response_strings['empty_query'])
+        terms = ' '.join(['"%s"' % word for word in words])
+
+        if fulltext_module == 'fts5':
+            rank = 'phonebook_fts.rank'
+        else:
+            # FTS4 has no ranking function; more matched terms give longer offsets
+            rank = 'length(offsets(phonebook_fts)) DESC'
+        q = db.query('''SELECT p.id, p.firstname, p.surname, p.number, p.address, p.json
+                              FROM phonebook_fts JOIN phonebook p ON p.id = phonebook_fts.rowid
+                              WHERE phonebook_fts MATCH $terms
+                              ORDER BY ''' + rank + ''' LIMIT $limit''',
+                     vars={'terms':terms, 'limit':limit})
+        return json_array(q)
+
+class NumberSearch:
+    def GET(self, digits):
+        '''Find the entries with a phone number, ignoring spaces, dashes and #.
+        A trailing * (/number/0204*) or ?match=prefix finds numbers starting
+        with the given digits. Returns JSON list of at most ?limit= results'''
+
+        params = web.input(match=None, limit=None)
+        limit = parse_int(params.limit, DEFAULT_PAGE_SIZE, 1, MAX_PAGE_SIZE, 'invalid_limit')
+        match = params.match or 'exact'
+        if digits.endswith('*'):
+            digits = digits[:-1]
+            match = 'prefix'
+
+        if match == 'exact':
+            where = "number_digits = $digits"
+        elif match == 'prefix':
+            where = "number_digits >= $digits AND number_digits < $high"
+        else:
+            raise web.badrequest(response_strings['invalid_number_match'])
+
+        if memory_index is not None:
+            return json_array(memory_index.numbers(match, digits, limit))
+        q = db.query('''SELECT id, firstname, surname, number, address, json
+                              FROM phonebook WHERE ''' + where + '''
+                              ORDER BY number_digits, id LIMIT $limit''',
+                     vars={'digits':digits, 'high':prefix_upper_bound(digits),
+                           'limit':limit})
+        return json_array(q)
+
+#####################
+##     Caching     ##
+#####################
+
+class LRUCache:
+    '''Thread-safe mapping that holds at most maxsize items, dropping the
+    least recently used item to make room, and counts hits and misses'''
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = web.LRUDict(maxsize, self._removed)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # Bumped whenever items are dropped or replaced because the data
+        # changed. A value read from the database while this changed may
+        # be stale, so put() discards it.
+        self.generation = 0
+
+    def get(self, key):
+        '''Returns the value for key, or None if it isn't cached'''
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return value
+
+    def put(self, key, value, generation=None):
+        '''Caches value for key, unless generation is given and the data has
+        changed since it was read'''
+        with self.lock:
+            if generation is None or generation == self.generation:
+                self.items.put(key, value)
+
+    def pop(self, key):
+        with self.lock:
+            self.generation += 1
+            self.items.pop(key)
+
+    def replace(self, key, expected, value):
+        '''Caches value for key if key still holds expected, otherwise drops
+        whatever key holds'''
+        with self.lock:
+            self.generation += 1
+            if self.items.peek(key) is expected:
+                self.items.put(key, value)
+            else:
+                self.items.pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.generation += 1
+            self.items.clear()
+
+    def _removed(self, key, value):
+        # Called, with the lock held, for each item leaving the cache.
+        # Subclasses extend this to tidy up.
+        pass
+
+    def snapshot(self):
+        '''Returns the cached (key, value) pairs, least recently used first'''
+        with self.lock:
+            return self.items.items()
+
+    def stats(self):
+        with self.lock:
+            return {'size':len(self.items), 'maxsize':self.maxsize,
+                    'hits':self.hits, 'misses':self.misses}
+
+class FrequencySketch:
+    '''Approximate counts of how often keys were seen recently, in a
+    count-min sketch of small counters. Counters are halved once
+    sample_size keys have been added, so old popularity fades.'''
+
+    depth = 4
+    max_count = 15
+
+    def __init__(self, size):
+        # A few counters per cached key keeps collisions rare
+        width = 64
+        while width < 4 * size:
+            width *= 2
+        self.mask = width - 1
+        self.rows = [bytearray(width) for i in range(self.depth)]
+        self.sample_size = 10 * max(size, 1)
+        self.additions = 0
+
+    def indexes(self, key):
+        return [hash((row, key)) & self.mask for row in range(self.depth)]
+
+    def add(self, key):
+        for row, index in zip(self.rows, self.indexes(key)):
+            if row[index] < self.max_count:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.age()
+
+    def estimate(self, key):
+        return min([row[index] for row, index in zip(self.rows, self.indexes(key))])
+
+    def age(self):
+        for i, row in enumerate(self.rows):
+            self.rows[i] = bytearray([count >> 1 for count in row])
+        self.additions //= 2
+
+class SearchCache(LRUCache):
+    '''Serialized surname search responses, keyed by search_key.
+    Remembers which entries each response lists, so a write to an entry
+    drops exactly the responses that include it.
+
+    When full, a new response only displaces the least recently used one
+    if its key has been searched for more often lately (TinyLFU), so a
+    scan over many rarely searched surnames doesn't flush popular ones.'''
+
+    def __init__(self, maxsize):
+        LRUCache.__init__(self, maxsize)
+        self.keys_by_id = {}
+        self.sketch = FrequencySketch(maxsize)
+        self.rejected = 0
+
+    def put(self, key, response, ids, generation):
+        '''Caches the response for key, listing entries ids, unless entries
+        have changed since generation was read, or the cache is full of
+        more frequently searched keys'''
+        with self.lock:
+            if generation != self.generation:
+                return
+            if key not in self.items and len(self.items) >= self.maxsize:
+                victim = self.items.oldest()
+                if self.sketch.estimate(key) <= self.sketch.estimate(victim):
+                    self.rejected += 1
+                    return
+            self.items.put(key, (response, ids))
+            if key in self.items:
+                for id in ids:
+                    self.keys_by_id.setdefault(id, set()).add(key)
+
+    def get(self, key):
+        with self.lock:
+            self.sketch.add(key)
+        value = LRUCache.get(self, key)
+        return value and value[0]
+
+    def stats(self):
+        stats = LRUCache.stats(self)
+        stats['rejected'] = self.rejected
+        return stats
+
+    def _removed(self, key, value):
+        for id in value[1]:
+            keys = self.keys_by_id.get(id)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_id[id]
+
+    def invalidate(self, ids=(), surnames=()):
+        '''Drops responses that list any of the entries ids, or that would
+        now match an entry with any of the surnames'''
+        with self.lock:
+            self.generation += 1
+            keys = set()
+            for id in ids:
+                keys.update(self.keys_by_id.get(id, ()))
+            for surname in surnames:
+                keys.add(search_key('exact', surname))
+                keys.add(search_key('phonetic', surname))
+                # Every prefix search this surname could match
+                folded = ascii_lower(web.safeunicode(surname))
+                for end in range(1, len(folded) + 1):
+                    keys.add(('prefix', folded[:end]))
+            for key in keys:
+                self.items.pop(key)
+
+def search_key(match, surname):
+    '''Returns the cache key for a surname search. Searches that must
+    give the same results share a key.'''
+    if match == 'phonetic':
+        return (match, soundex(surname))
+    return (match, ascii_lower(web.safeunicode(surname)))
+
+search_cache = SearchCache(SEARCH_CACHE_SIZE)
+
+# (JSON array, id to continue after) for listing pages, keyed by
+# (after, limit). Any write can change any page, so writes clear it.
+page_cache = LRUCache(PAGE_CACHE_SIZE)
+
+# Bumped on every write, so clients can revalidate listings and searches
+# by ETag. The process start time makes ETags from before a restart,
+# when the count starts again, never match.
+data_version = 0
+data_version_lock = threading.Lock()
+data_epoch = '%x' % int(time.time() * 1000)
+
+def data_etag():
+    '''Returns the ETag for the current version of the phonebook data'''
+    return '%s-%d' % (data_epoch, data_version)
+
+# (entry dict, version) for single entries, keyed by id
+entry_cache = LRUCache(ENTRY_CACHE_SIZE)
+
+def entries_changed(ids=(), surnames=(), replaced=None):
+    '''Called after entries are written, with the ids of added, changed
+    and deleted entries and the new surnames written, to drop cached
+    responses they affect. replaced maps ids to (cached value, new value)
+    for entries whose new value is known, so they are updated in place
+    rather than dropped. Inside a request transaction this waits until
+    the transaction commits.'''
+    global data_version
+    if web.ctx.get('after_commit') is not None:
+        web.ctx.after_commit.append(lambda: entries_changed(ids, surnames, replaced))
+        return
+    if memory_index is not None:
+        memory_index.refresh(db, ids)
+    with data_version_lock:
+        data_version += 1
+    search_cache.invalidate(ids, surnames)
+    page_cache.clear()
+    for id in ids:
+        if replaced and id in replaced:
+            entry_cache.replace(id, *replaced[id])
+        else:
+            entry_cache.pop(id)
+
+class SingleFlight:
+    '''Runs at most one call per key at a time. Threads asking for a key
+    that is already being computed wait for that call and share its
+    result, or its exception, instead of repeating the work.'''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.computed = self.shared = 0
+
+    def do(self, key, function):
+        '''Returns function(), or the result of the call in flight for key'''
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = web.storage(done=threading.Event(),
+                                                     result=None, error=None)
+                self.computed += 1
+                leader = True
+            else:
+                self.shared += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error[0], call.error[1], call.error[2]
+            return call.result
+
+        try:
+            call.result = function()
+        except:
+            call.error = sys.exc_info()
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result
+
+    def stats(self):
+        with self.lock:
+            return {'in_flight':len(self.calls), 'computed':self.computed,
+                    'shared':self.shared}
+
+def search_response(match, surname, where, vars):
+    '''Returns the JSON array for a surname search, whose WHERE clause
+    and vars are given by surname_clause, from the search cache or by
+    running the search and caching the result'''
+    key = search_key(match, surname)
+    response = search_cache.get(key)
+    if response is not None:
+        return response
+
+    def search():
+        generation = search_cache.generation
+        if memory_index is not None:
+            rows = memory_index.search(match, surname)
+        else:
+            rows = db.query('''SELECT id, firstname, surname, number, address, json
+                                  FROM phonebook WHERE ''' + where + '''
+                                  ORDER BY surname COLLATE NOCASE, firstname COLLATE NOCASE''',
+                            vars=vars).list()
+        response = json_array(rows)
+        search_cache.put(key, response, [row.id for row in rows], generation)
+        return response
+    return read_flight.do(('search', data_version) + key, search)
+
+def page_response(after, limit):
+    '''Returns entry_page(after, limit), from the page cache or by reading
+    the page and caching it'''
+    key = (after, limit)
+    page = page_cache.get(key)
+    if page is not None:
+        return page
+
+    def read():
+        generation = page_cache.generation
+        page = entry_page(after, limit)
+        page_cache.put(key, page, generation)
+        return page
+    return read_flight.do(('list', data_version) + key, read)
+
+def save_cache_snapshot(path):
+    '''Writes the searches and listing pages currently cached to path, for
+    warm_caches to repeat when the service next starts'''
+    searches = []
+    for (match, value), (response, ids) in search_cache.snapshot():
+        if match == 'phonetic':
+            # The key is a Soundex code; any surname found has that code
+            if not ids:
+                continue
+            value = json.loads(response)[0]['surname']
+        searches.append([match, value])
+    pages = [list(key) for key, page in page_cache.snapshot()]
+    web.safewrite(path, json.dumps({'searches':searches, 'pages':pages}))
+
+def warm_caches(path):
+    '''Fills the search and page caches by repeating the searches and page
+    reads in the snapshot at path, least recently used first. Does nothing
+    if there is no readable snapshot, and skips entries in it that are
+    invalid, so a damaged or outdated snapshot never stops the service
+    from starting.'''
+    try:
+        with open(path) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return
+    if not isinstance(snapshot, dict):
+        return
+    for key in snapshot.get('searches', []):
+        try:
+            match, surname = key
+            if not (match in ('exact', 'prefix', 'phonetic') and isinstance(surname, basestring)
+                    and (surname or match != 'prefix')):
+                raise ValueError('not a valid search')
+            search_response(match, surname, *surname_clause(match, surname))
+        except Exception, e:
+            print >> sys.stderr, 'Skipping search %r in cache snapshot: %s' % (key, e)
+    for key in snapshot.get('pages', []):
+        try:
+            after, limit = key
+            if not (isinstance(after, (int, long)) and isinstance(limit, (int, long))
+                    and 0 <= after <= MAX_ENTRY_ID and 1 <= limit <= MAX_PAGE_SIZE):
+                raise ValueError('not a valid page')
+            page_response(after, limit)
+        except Exception, e:
+            print >> sys.stderr, 'Skipping page %r in cache snapshot: %s' % (key, e)
+
+# Concurrent identical listing and search requests share one query. Keys
+# include data_version, so a request arriving after a write never shares
+# a read that started before it.
+read_flight = SingleFlight()
+
+#####################
+## In-memory reads ##
+#####################
+
+class MemoryIndex:
+    '''The whole phonebook held in memory, with the orderings needed to
+    serve listings, surname searches, number lookups and single entries
+    without querying SQLite. Writes still go to SQLite; the entries they
+    touch are then re-read by refresh().'''
+
+    columns = 'id, firstname, surname, number, address, version, surname_key, number_digits, json'
+
+    def __init__(self, database):
+        self.lock = threading.Lock()
+        # Serializes refreshes, so a later one always applies newer rows
+        self.refresh_lock = threading.Lock()
+        self.entries = {}
+        # Sorted lists: ids, (folded surname, folded firstname, id) and
+        # (number digits, id)
+        self.ids = []
+        self.by_surname = []
+        self.by_number = []
+        # Soundex key -> set of ids
+        self.surname_keys = {}
+        self.load(database)
+
+    def load(self, database):
+        '''Replaces the contents of the index with every entry in database'''
+        with self.refresh_lock:
+            rows = database.query('SELECT %s FROM phonebook' % self.columns)
+            entries = dict((row.id, self.entry(row)) for row in rows)
+            with self.lock:
+                self.entries = {}
+                self.ids, self.by_surname, self.by_number = [], [], []
+                self.surname_keys = {}
+                self.update([], entries.values())
+
+    def refresh(self, database, ids):
+        '''Re-reads the entries with these ids from database, adding,
+        replacing or removing them in the index'''
+        ids = set(ids)
+        with self.refresh_lock:
+            rows = {}
+            for group in web.group(ids, MAX_IN_LIST):
+                for row in database.query('SELECT %s FROM phonebook WHERE id IN $ids'
+                                          % self.columns, vars={'ids':group}):
+                    rows[row.id] = self.entry(row)
+            with self.lock:
+                removed = [self.entries[id] for id in ids if id in self.entries]
+                self.update(removed, rows.values())
+
+    def entry(self, row):
+        '''Returns the in-memory form of a phonebook row'''
+        entry = web.storage(row)
+        entry.json = web.safestr(row.json) if row.json is not None else None
+        # SQLite never matches a NULL surname in a search, so entries
+        # without one are left out of by_surname
+        entry.surname_order = None
+        if row.surname is not None:
+            entry.surname_order = (ascii_lower(web.safeunicode(row.surname)),
+                                   ascii_lower(web.safeunicode(row.firstname or u'')), row.id)
+        return entry
+
+    def update(self, removed, added):
+        '''Removes then adds entries, keeping every index in order.
+        Called with the lock held.'''
+        for entry in removed:
+            del self.entries[entry.id]
+            if entry.surname_key is not None:
+                self.surname_keys[entry.surname_key].discard(entry.id)
+                if not self.surname_keys[entry.surname_key]:
+                    del self.surname_keys[entry.surname_key]
+        for entry in added:
+            self.entries[entry.id] = entry
+            if entry.surname_key is not None:
+                self.surname_keys.setdefault(entry.surname_key, set()).add(entry.id)
+        sorted_update(self.ids, [e.id for e in removed], [e.id for e in added])
+        sorted_update(self.by_surname, [e.surname_order for e in removed if e.surname_order],
+                      [e.surname_order for e in added if e.surname_order])
+        sorted_update(self.by_number, [(e.number_digits, e.id) for e in removed],
+                      [(e.number_digits, e.id) for e in added])
+
+    def get(self, id):
+        return self.entries.get(id)
+
+    def page(self, after, limit):
+        '''Returns up to limit entries with ids greater than after'''
+        with self.lock:
+            start = bisect.bisect_right(self.ids, after)
+            return [self.entries[id] for id in self.ids[start:start+limit]]
+
+    def search(self, match, surname):
+        '''Returns entries matching a surname search, in the order of
+        the equivalent query'''
+        with self.lock:
+            if match == 'phonetic':
+                ids = self.surname_keys.get(soundex(surname), ())
+                return sorted([self.entries[id] for id in ids],
+                              key=lambda entry: entry.surname_order)
+            folded = ascii_lower(web.safeunicode(surname))
+            results = []
+            for order in self.by_surname[bisect.bisect_left(self.by_surname, (folded,)):]:
+                if order[0] != folded and not (match == 'prefix' and order[0].startswith(folded)):
+                    break
+                results.append(self.entries[order[2]])
+            return results
+
+    def numbers(self, match, digits, limit):
+        '''Returns up to limit entries whose number digits equal, or with
+        match='prefix' start with, digits'''
+        with self.lock:
+            results = []
+            for number, id in self.by_number[bisect.bisect_left(self.by_number, (digits,)):]:
+                if len(results) == limit or not (number == digits or
+                        (match == 'prefix' and number.startswith(digits))):
+                    break
+                results.append(self.entries[id])
+            return results
+
+    def stats(self):
+        return {'entries':len(self.entries)}
+
+def sorted_update(items, removed, added):
+    '''Removes then adds values in the sorted list items, in place'''
+    if len(removed) > 8:
+        removed = set(removed)
+        items[:] = [item for item in items if item not in removed]
+    else:
+        for item in removed:
+            del items[bisect.bisect_left(items, item)]
+    if len(added) > 8:
+        # Sorting a sorted list with a tail of additions is linear
+        items.extend(added)
+        items.sort()
+    else:
+        for item in added:
+            bisect.insort(items, item)
+
+# Set to a MemoryIndex to serve reads from memory. Set at startup when
+# PHONEBOOK_IN_MEMORY is in the environment.
+memory_index = None
+
+######################
+## Write-behind log ##
+######################
+
+class WriteBehindLog:
+    '''Takes validated entries to add to the database later. Each entry
+    is appended to a log file under a tracking id and synced to disk
+    before the client is answered. A background thread reads the log and
+    inserts the entries in batches, recording in the ingested table the
+    id each tracking id got, or why its entry could not be added. Entries
+    already added are then cut from the front of the log.'''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.appended = threading.Condition(self.lock)
+        self.file = None
+        self.thread = None
+        self.stopping = False
+        # Log bytes written, and those already added to the database
+        self.size = self.offset = 0
+        # Last tracking id given out, and last one added to the database
+        self.last_tid = self.drained_tid = 0
+
+    def start(self):
+        '''Opens the log and starts adding the entries in it, including any
+        left from before a restart. Does nothing if already started.'''
+        with self.lock:
+            if self.thread is not None:
+                return
+            self.drained_tid = self.ingested_tid()
+            self.last_tid = self.drained_tid
+            # Read a line at a time, for the end of the last whole record
+            # and the last tracking id given out
+            self.size = self.offset = 0
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as log:
+                    for line in log:
+                        if not line.endswith('\n'):
+                            break
+                        self.size += len(line)
+                        try:
+                            self.last_tid = max(self.last_tid, int(json.loads(line)['tid']))
+                        except (ValueError, KeyError, TypeError):
+                            # Rejected when the drainer reaches it
+                            pass
+            self.file = open(self.path, 'ab')
+            # Drop a record left half written by a crash
+            self.file.truncate(self.size)
+            self.thread = threading.Thread(target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        '''Stops the background thread once every logged entry has been added'''
+        with self.lock:
+            if self.thread is None:
+                return
+            self.stopping = True
+            self.appended.notify()
+        self.thread.join()
+        with self.lock:
+            self.file.close()
+            self.file = self.thread = None
+            self.stopping = False
+
+    def append(self, data):
+        '''Logs validated entry data to be added. Returns its tracking id
+        once the log is on disk.'''
+        self.start()
+        with self.lock:
+            tid = self.last_tid + 1
+            line = json.dumps({'tid':tid, 'entry':data}) + '\n'
+            self.file.write(line)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.last_tid = tid
+            self.size += len(line)
+            self.appended.notify()
+        return tid
+
+    def run(self):
+        '''Background thread: adds entries as they are logged'''
+        while True:
+            with self.lock:
+                while self.offset == self.size and not self.stopping:
+                    self.appended.wait()
+                if self.offset == self.size:
+                    return
+                end = self.size
+            try:
+                self.drain(end)
+                self.compact()
+            except Exception:
+                # The database is unavailable; records it refused are
+                # rejected by add() rather than retried
+                traceback.print_exc()
+                if self.stopping:
+                    # The rest is added after the next start
+                    return
+                time.sleep(WRITE_LOG_RETRY_DELAY)
+
+    def drain(self, end):
+        '''Adds the entries logged before byte end, in batches'''
+        with open(self.path, 'rb') as log:
+            log.seek(self.offset)
+            while log.tell() < end:
+                lines = []
+                while log.tell() < end and len(lines) < BULK_BATCH_SIZE:
+                    lines.append(log.readline())
+                records = []
+                for line in lines:
+                    try:
+                        records.append((line, self.parse(line)))
+                    except ValueError, e:
+                        self.add(records)
+                        records = []
+                        self.reject(line, str(e))
+                self.add(records)
+
+    def parse(self, line):
+        '''Returns the record logged on line. Raises ValueError if it is not
+        a valid record, so can never be added.'''
+        record = json.loads(line)
+        if not (isinstance(record, dict) and isinstance(record.get('tid'), (int, long))
+                and isinstance(record.get('entry'), dict)):
+            raise ValueError(response_strings['invalid_log_record'])
+        check_fields(record['entry'], entry_required_attrs, entry_attrs)
+        return record
+
+    def add(self, records):
+        '''Adds (line, record) pairs to the database and moves past them.
+        If the batch fails, adds them one at a time, so a record the
+        database refuses is rejected without holding up the others.'''
+        if not records:
+            return
+        try:
+            self.insert([record for line, record in records])
+        except db.db_module.OperationalError:
+            # Locked, busy or out of space: worth retrying as they are
+            raise
+        except Exception, e:
+            if len(records) > 1:
+                for record in records:
+                    self.add([record])
+                return
+            self.reject(records[0][0], str(e))
+            return
+        self.advance(sum([len(line) for line, record in records]))
+
+    def insert(self, records):
+        '''Adds logged records to the database in one transaction, skipping
+        those added before a restart'''
+        self.drained_tid = self.ingested_tid()
+        records = [record for record in records if record['tid'] > self.drained_tid]
+        if not records:
+            return
+        entries = [record['entry'] for record in records]
+        with db.transaction():
+            ids = db.multiple_insert('phonebook', [entry_row(data) for data in entries],
+                                     seqname='id')
+            db.multiple_insert('ingested', [{'tid':record['tid'], 'entry_id':id}
+                                            for record, id in zip(records, ids)],
+                               seqname=False)
+            db.delete('ingested', where='tid <= $tid',
+                      vars={'tid':records[-1]['tid'] - MAX_TRACKED_TIDS})
+        self.drained_tid = records[-1]['tid']
+        entries_changed(ids=ids, surnames=[data['surname'] for data in entries])
+
+    def reject(self, line, error):
+        '''Records that the logged line can't be added, and moves past it'''
+        print >> sys.stderr, 'Write log record not added (%s): %r' % (error, line)
+        try:
+            tid = json.loads(line)['tid']
+        except (ValueError, KeyError, TypeError):
+            tid = None
+        if isinstance(tid, (int, long)) and 0 < tid <= MAX_ENTRY_ID:
+            db.query('INSERT OR IGNORE INTO ingested (tid, error) VALUES ($tid, $error)',
+                     vars={'tid':tid, 'error':error})
+            self.drained_tid = max(self.drained_tid, tid)
+        self.advance(len(line))
+
+    def advance(self, length):
+        with self.lock:
+            self.offset += length
+
+    def compact(self):
+        '''Cuts the entries already added from the front of the log, once
+        they are all of it or at least WRITE_LOG_COMPACT_SIZE bytes'''
+        with self.lock:
+            if self.offset == self.size:
+                self.file.truncate(0)
+            elif self.offset >= WRITE_LOG_COMPACT_SIZE:
+                with open(self.path, 'rb') as log:
+                    log.seek(self.offset)
+                    rest = log.read(self.size - self.offset)
+                with open(self.path + '.tmp', 'wb') as f:
+                    f.write(rest)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.rename(self.path + '.tmp', self.path)
+                self.file.close()
+                self.file = open(self.path, 'ab')
+            else:
+                return
+            self.size -= self.offset
+            self.offset = 0
+
+    def ingested_tid(self):
+        return db.query('SELECT max(tid) AS tid FROM ingested')[0].tid or 0
+
+    def stats(self):
+        return {'pending':self.last_tid - self.drained_tid, 'last_tid':self.last_tid}
+
+# Set to a WriteBehindLog to accept entries posted with Prefer:
+# respond-async. Enabled by setting PHONEBOOK_WRITE_LOG in the
+# environment to the log's file name.
+write_log = None
+if os.environ.get('PHONEBOOK_WRITE_LOG'):
+    write_log = WriteBehindLog(os.environ['PHONEBOOK_WRITE_LOG'])
+
+##########################
+## Request transactions ##
+##########################
+
+# Request methods that may write, and so run in a request transaction
+write_methods = ('POST', 'PUT', 'PATCH', 'DELETE')
+
+def transaction_processor(handler):
+    '''Runs each write request in one database transaction, so a handler
+    making several writes commits once. The transaction commits when the
+    handler returns or raises a 2xx or 3xx status, and is rolled back on
+    any other error. Transactions the handler opens itself join it.
+    Handler classes with transactional = False run without one.
+    Cache invalidations from entries_changed run after the commit.'''
+    if web.ctx.method not in write_methods:
+        return handler()
+    # fvars is the module being served, which web.py reloads in debug mode
+    handlers = app.fvars
+    name, args = app._match(app.mapping, web.ctx.path)
+    if not getattr(handlers.get(name), 'transactional', True):
+        return handler()
+    # Entries handed to the write log don't touch the database
+    if (getattr(handlers.get(name), 'writes_behind', False)
+            and handlers['write_log'] is not None and respond_async()):
+        return handler()
+
+    database = handlers['db']
+    # Read the body before the transaction takes the pool's writer, so a
+    # client slow to send it doesn't hold up every other write
+    web.data()
+    web.ctx.after_commit = []
+    t = database.transaction()
+    database.ctx.ignore_nested_transactions = True
+    try:
+        try:
+            result = handler()
+        except web.HTTPError:
+            committed = web.ctx.status[:1] in '23'
+            raise
+        except:
+            committed = False
+            raise
+        else:
+            committed = True
+        return result
+    finally:
+        del database.ctx.ignore_nested_transactions
+        after_commit = web.ctx.pop('after_commit')
+        if committed:
+            t.commit()
+            for function in after_commit:
+                function()
+        else:
+            t.rollback()
+
+app.add_processor(transaction_processor)
+
 #####################
 ## Utility methods ##
 #####################
 
-def entry_exists(entry_id):
-    result = db.where('phonebook',id=entry_id)
-    if len(list(result)) > 0:
+def respond_async():
+    '''Whether the client sent Prefer: respond-async, so would rather not
+    wait for its write to be committed'''
+    preferences = web.ctx.env.get('HTTP_PREFER', '').split(',')
+    return 'respond-async' in [p.split(';')[0].strip().lower() for p in preferences]
+
+def entry_dict(row):
+    '''Converts a phonebook row into the dict returned as JSON'''
+    return {'id':row.id,
+            'firstname':row.firstname,
+            'surname':row.surname,
+            'number':row.number,
+            'address':row.address}
+
+def entry_json(row):
+    '''Returns a phonebook row as a UTF-8 JSON object, using the stored
+    serialization in its json column when there is one'''
+    if row.get('json') is not None:
+        return web.safestr(row.json)
+    return json.dumps(entry_dict(row))
+
+def json_array(rows):
+    '''Returns phonebook rows as a JSON array of entries'''
+    return '[' + ', '.join([entry_json(row) for row in rows]) + ']'
+
+def surname_clause(match, surname):
+    '''Returns the WHERE clause and vars for a surname search, written so
+    that SQLite can answer it from the NOCASE surname index.
+    Raises 400 Bad request for an unknown match mode or empty prefix.'''
+    if match == 'exact':
+        return "surname = $surname COLLATE NOCASE", {'surname':surname}
+    elif match == 'prefix':
+        if not surname:
+            raise web.badrequest(response_strings['empty_prefix'])
+        # NOCASE only folds ASCII letters, so fold the same way before
+        # computing the upper bound of the range
+        low = ascii_lower(web.safeunicode(surname))
+        high = prefix_upper_bound(low)
+        if high is None:
+            return "surname >= $low COLLATE NOCASE", {'low':low}
+        return ("surname >= $low COLLATE NOCASE AND surname < $high COLLATE NOCASE",
+                {'low':low, 'high':high})
+    elif match == 'phonetic':
+        return "surname_key = $key", {'key':soundex(surname)}
+    raise web.badrequest(response_strings['invalid_match'])
+
+def ascii_lower(text):
+    '''Lowercases ASCII letters only, as SQLite's NOCASE collation does'''
+    return re.sub('[A-Z]', lambda m: m.group(0).lower(), text)
+
+def prefix_upper_bound(prefix):
+    '''Returns the smallest string greater than every string starting with
+    prefix, or None if there is no such string'''
+    while prefix:
+        last = ord(prefix[-1])
+        if last < sys.maxunicode:
+            return prefix[:-1] + unichr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+def entry_page(after, limit):
+    '''Returns the JSON array of up to limit entries after the given id,
+    and the id of the last one if there are more entries after it'''
+    # Keyset pagination: the id index finds the start of the page, so
+    # the cost is bounded by the page size rather than the table size.
+    # One extra row tells us whether there is a next page.
+    if memory_index is not None:
+        rows = memory_index.page(after, limit+1)
+    else:
+        rows = db.query('''SELECT id, firstname, surname, number, address, json
+                              FROM phonebook WHERE id > $after
+                              ORDER BY id LIMIT $limit''',
+                        vars={'after':after, 'limit':limit+1}).list()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        return json_array(rows), rows[-1].id
+    return json_array(rows), None
+
+def entry_batches(after=0, batch_size=None):
+    '''Yields lists of up to batch_size (default STREAM_BATCH_SIZE) phonebook
+    rows in id order, starting after the given id. Each batch is a separate
+    keyset query, so no read is held open on the database between batches.'''
+    batch_size = batch_size or STREAM_BATCH_SIZE
+    while True:
+        batch = db.query('''SELECT id, firstname, surname, number, address, json
+                              FROM phonebook WHERE id > $after
+                              ORDER BY id LIMIT $limit''',
+                         vars={'after':after, 'limit':batch_size}).list()
+        if not batch:
+            return
+        yield batch
+        if len(batch) < batch_size:
+            return
+        after = batch[-1].id
+
+def json_array_chunks(batches):
+    '''Yields a JSON array of entries piece by piece, one chunk per batch'''
+    yield '['
+    separator = ''
+    for batch in batches:
+        yield separator + ', '.join([entry_json(row) for row in batch])
+        separator = ', '
+    yield ']'
+
+def ndjson_chunks(batches):
+    '''Yields entries as NDJSON, one chunk per batch'''
+    for batch in batches:
+        yield ''.join([entry_json(row) + '\n' for row in batch])
+
+# Column order of CSV exports
+export_fields = ['id', 'firstname', 'surname', 'number', 'address']
+
+def csv_chunks(batches):
+    '''Yields entries as UTF-8 CSV with a header row, one chunk per batch'''
+    yield ','.join(export_fields) + '\r\n'
+    for batch in batches:
+        out = StringIO.StringIO()
+        writer = csv.writer(out)
+        for row in batch:
+            entry = entry_dict(row)
+            writer.writerow([web.safestr(entry[field]) if entry[field] is not None else ''
+                             for field in export_fields])
+        yield out.getvalue()
+
+def accepts_gzip():
+    '''Returns True if the request's Accept-Encoding allows gzip'''
+    for coding in web.ctx.env.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        parts = coding.lower().split(';')
+        if parts[0].strip() not in ('gzip', 'x-gzip'):
+            continue
+        for param in parts[1:]:
+            name, _, value = param.partition('=')
+            if name.strip() == 'q':
+                # gzip;q=0 means the client refuses gzip
+                try:
+                    return float(value) > 0
+                except ValueError:
+                    return False
         return True
     return False
 
+def gzip_chunks(chunks):
+    '''Yields chunks compressed as a single gzip stream'''
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+def parse_int(value, default, minimum, maximum, error):
+    '''Parses an integer query parameter, falling back to default when absent.
+    Raises 400 Bad request with response_strings[error] if it is not a
+    whole number between minimum and maximum (either may be None).'''
+    if value is None or value == '':
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise web.badrequest(response_strings[error])
+    if (minimum is not None and value < minimum) or \
+       (maximum is not None and value > maximum):
+        raise web.badrequest(response_strings[error])
+    return value
+
+def check_operation(op):
+    '''Returns the result of a batch operation, with status None if it is
+    valid or 400 and the reason if not'''
+    result = {'id':None, 'status':None}
+    if not isinstance(op, dict):
+        result.update(status=400, error=response_strings['invalid_operation'])
+        return result
+    result['id'] = op.get('id')
+    if not isinstance(op.get('id'), (int, long)) or isinstance(op['id'], bool) or \
+       op.get('op') not in ('update', 'delete') or \
+       set(op.keys()) - set(['op', 'id', 'data']):
+        result.update(status=400, error=response_strings['invalid_operation'])
+    elif op['op'] == 'update':
+        data = op.get('data')
+        if not isinstance(data, dict) or not data:
+            result.update(status=400, error=response_strings['update_fields'])
+        else:
+            try:
+                check_fields(data, [], entry_attrs)
+            except ValueError, e:
+                result.update(status=400, error=str(e))
+    return result
+
+def entry_row(data):
+    '''Returns the phonebook column values to insert for validated entry data'''
+    row = {'firstname':data['firstname'],
+           'surname':data['surname'],
+           'number':data['number'],
+           # Missing or empty address is stored as None
+           'address':data.get('address') or None}
+    row.update(derived_fields(row))
+    return row
+
+def insert_entries(entries):
+    '''Inserts validated entries in one transaction. Returns their ids.'''
+    with db.transaction():
+        ids = db.multiple_insert('phonebook', [entry_row(data) for data in entries],
+                                 seqname='id')
+    entries_changed(ids=ids, surnames=[data['surname'] for data in entries])
+    return ids
+
+def request_lines():
+    '''Yields the lines of the request body, reading it as they are needed'''
+    input = web.ctx.env['wsgi.input']
+    remaining = web.intget(web.ctx.env.get('CONTENT_LENGTH'))
+    while remaining is None or remaining > 0:
+        if remaining is None:
+            line = input.readline()
+        else:
+            line = input.readline(remaining)
+            remaining -= len(line)
+        if not line:
+            return
+        yield line
+
+def ndjson_records(lines):
+    '''Yields (line number, entry data, error) for each non-blank line of
+    NDJSON, where error is None unless the line isn't a JSON object'''
+    for number, line in enumerate(lines):
+        if not line.strip():
+            continue
+        try:
+            data = json.loads(line)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            yield number + 1, data, None
+        else:
+            yield number + 1, None, response_strings['invalid_json']
+
+def csv_records(lines):
+    '''Yields (line number, entry data, None) for each row of CSV whose
+    first row names the fields. Empty cells count as missing fields.'''
+    reader = csv.reader(lines)
+    try:
+        fields = reader.next()
+    except StopIteration:
+        return
+    for row in reader:
+        if not row:
+            continue
+        data = {}
+        for i, value in enumerate(row):
+            # Cells beyond the header are reported as unrecognized fields
+            field = i < len(fields) and fields[i].strip() or ''
+            if value:
+                data[field] = web.safeunicode(value)
+        yield reader.line_num, data, None
+
+def parse_entry_id(id):
+    '''Returns the entry id from a URI as an integer. Raises 404 Not Found
+    for ids too large for SQLite, which no entry can have.'''
+    entry_id = int(id)
+    if entry_id > MAX_ENTRY_ID:
+        raise web.notfound(response_strings['not_found'] % id)
+    return entry_id
+
+def entry_clause(entry_id):
+    '''Returns the WHERE clause and vars matching an entry by id and, if the
+    request has an If-Match header, by version'''
+    vars = {'id':entry_id}
+    versions = if_match_versions()
+    if versions is None:
+        return "id=$id", vars
+    vars['versions'] = versions
+    return "id=$id AND version IN $versions", vars
+
+def if_match_versions():
+    '''Returns the entry versions listed in the If-Match header, or None if
+    there is no header or it is *'''
+    header = web.ctx.env.get('HTTP_IF_MATCH', '').strip()
+    if not header or header == '*':
+        return None
+    versions = []
+    for etag in header.split(','):
+        try:
+            versions.append(int(etag.strip().strip('"')))
+        except ValueError:
+            # Not one of our ETags, so it can never match
+            pass
+    return versions or [0]
+
+def write_failed(entry_id):
+    '''Raises 404 Not Found, or 412 Precondition Failed if the entry exists
+    but its version didn't match If-Match. Only called when a write
+    changed no rows, so the common path costs a single statement.'''
+    if if_match_versions() is not None and db.where('phonebook', what='id', id=entry_id).list():
+        raise web.preconditionfailed(response_strings['version_mismatch'])
+    raise web.notfound(response_strings['not_found'] % entry_id)
+
 def validate_fields(data, required_attrs, all_attrs):
+    # Raises 400 Bad request with the reason if data isn't valid
+    try:
+        check_fields(data, required_attrs, all_attrs)
+    except ValueError, e:
+        raise web.badrequest(e)
+
+def check_fields(data, required_attrs, all_attrs):
     # Make sure all required attributes are present
     for required_attr in required_attrs:
         if not required_attr in data.keys():
-            raise web.badrequest(response_strings['missing_field'])
+            raise ValueError(response_strings['missing_field'])
 
     # Make sure there aren't any extra, unrecognised fields
     for key in data:
         if key not in all_attrs:
-            raise web.badrequest(response_strings['unrecognized_field'])
+            raise ValueError(response_strings['unrecognized_field'])
         # Validate input
-        try:
-            validate_data(data[key], key, all_attrs)
-        except ValueError, e:
-            raise web.badrequest(e)
+        validate_data(data[key], key, all_attrs)
 
 def validate_data(data, field, all_attrs):
     def validate_number(data):
         # Vague regex for phone number, inc spaces, dashes, extension hash
         p = "[0-9- #]{6,15}"
-        if not re.search(p, data):
+        if not isinstance(data, basestring) or not re.search(p, data):
             raise ValueError(response_strings['invalid_number'])
 
     def validate_string(data):
@@ -151,12 +1746,21 @@ def validate_data(data, field, all_attrs):
         if not data:
             raise ValueError(response_strings['empty_string'])
     
+    def validate_type(data):
+        # Fields are strings; only address may be null
+        if data is None and field != 'address':
+            raise ValueError(response_strings['empty_string'])
+        if data is not None and not isinstance(data, basestring):
+            raise ValueError(response_strings['invalid_type'])
+
     if field not in all_attrs:
         raise ValueError(response_strings['unrecognized_field'])
     if field == 'number':
         validate_number(data)
-    elif field == 'firstname' or field == 'lastname':
-        validate_string(data)
+    else:
+        validate_type(data)
+        if field == 'firstname' or field == 'lastname':
+            validate_string(data)
 
 def load_json(input):
     try:
@@ -174,9 +1778,51 @@ response_strings = {
     'add_success':"Successfully added %s %s",
     'invalid_number':"Phone number must be 6-15 digits long, and contain only numbers, -, # or spaces.",
     'empty_string':"Field must not be null or an empty string.",
+    'invalid_type':"Field must be a string.",
     'entry_exists':"Could not create new entry for %s %s as one already exists.",
-    'update_fields':"Update PUT request must contain at least one field."
+    'update_fields':"Update PUT request must contain at least one field.",
+    'invalid_limit':"Page limit must be a whole number between 1 and %d." % MAX_PAGE_SIZE,
+    'invalid_cursor':"Page cursor (after) must be a non-negative entry id.",
+    'invalid_match':"Search match must be one of: exact, prefix, phonetic.",
+    'empty_prefix':"Prefix search must include at least one character before *.",
+    'empty_query':"Search query (q) must contain at least one word.",
+    'invalid_number_match':"Number match must be one of: exact, prefix.",
+    'invalid_format':"Export format must be one of: ndjson, csv.",
+    'invalid_batch':"Batch request must be a JSON list of operations.",
+    'batch_too_large':"Batch request must contain at most %d operations." % MAX_BATCH_OPERATIONS,
+    'invalid_operation':"Operation must have an op of update or delete, an integer id, and data for an update.",
+    'duplicate_operation':"Entry appears in more than one operation.",
+    'not_found':"No matching phonebook entry with id %s",
+    'pending_not_found':"No entry waiting to be added with tracking id %s",
+    'invalid_log_record':"Not a write log record.",
+    'version_mismatch':"Phonebook entry has changed since the If-Match version."
     }
 
 if __name__ == "__main__":
-    app.run()
\ No newline at end of file
+    # With PHONEBOOK_CACHE_SNAPSHOT set to a file name, the caches are
+    # warmed from that file at startup and it is rewritten at shutdown
+    snapshot = os.environ.get('PHONEBOOK_CACHE_SNAPSHOT')
+    if web.config.debug:
+        # In debug mode web.py imports this file again as the phonebook
+        # module and serves requests from there, so its caches are used
+        import phonebook as serving
+    else:
+        serving = sys.modules[__name__]
+    # Brings the database up to date before anything reads it
+    init_schema(serving.db)
+    if os.environ.get('PHONEBOOK_IN_MEMORY'):
+        serving.memory_index = MemoryIndex(serving.db)
+    if snapshot:
+        serving.warm_caches(snapshot)
+    if serving.write_log is not None:
+        # Adds entries logged before the last shutdown straight away
+        serving.write_log.start()
+    if snapshot or serving.write_log is not None:
+        # Stop cleanly on SIGTERM as on Ctrl-C, so the snapshot is saved
+        # and logged entries are added
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    app.run()
+    if snapshot:
+        serving.save_cache_snapshot(snapshot)
+    if serving.write_log is not None:
+        serving.write_log.stop()
\ No newline at end of file
@@ -1,15 +1,22 @@
 import phonebook
-import web, unittest, json
+import web, unittest, json, csv, zlib, threading, time, os, StringIO
 
 # Override phonebook DB with our test DB
-phonebook.db = web.database(dbn="sqlite", db="test_phonebook.db")
+phonebook.db = web.database(dbn="sqlite", db="test_phonebook.db", profile="performance", pool=4)
 db = phonebook.db
+phonebook.init_schema(db)
 
 class TestPhonebook(unittest.TestCase):
     
     def tearDown(self):
         '''Clear data from the db at end of each test'''
         db.query('DELETE FROM phonebook')
+        db.query('DELETE FROM ingested')
+        # Deleted behind the app's back, so drop anything it has cached
+        phonebook.search_cache.clear()
+        phonebook.entry_cache.clear()
+        phonebook.page_cache.clear()
+        phonebook.memory_index = None
 
 #############################
 ##      Create (POST)      ##
@@ -144,6 +151,149 @@ class TestPhonebook(unittest.TestCase):
         self.assertEqual(response.data, phonebook.response_strings['invalid_json'])
 
 
+#############################
+##    Read one (GET)       ##
+#############################
+
+    def test_get_entry(self):
+        '''Test fetching one entry by id, with its version as the ETag'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+
+        response = phonebook.app.request(uri, method='GET')
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(response.headers['ETag'], '"1"')
+        minnie = self.json_data(response.data)
+        self.assertEqual(minnie['id'], int(uri[1:]))
+        self.assertEqual(minnie['firstname'], "Minnie")
+        self.assertEqual(minnie['address'], None)
+
+        response = phonebook.app.request(uri, method='GET', headers={'If-None-Match':'"1"'})
+        self.assertEqual(response.status, "304 Not Modified")
+
+        response = phonebook.app.request('/10', method='GET')
+        self.assertEqual(response.status, "404 Not Found")
+
+    def test_get_entry_cache(self):
+        '''Test that the cached entry is updated by PUT and dropped by DELETE'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+        entry_id = int(uri[1:])
+        phonebook.app.request(uri, method='GET')
+        cached = phonebook.entry_cache.get(entry_id)
+        self.assertEqual(cached[1], 1)
+
+        phonebook.app.request(uri, method='PUT', data='{"address":"Disneyland"}')
+        # Updated in place with the new fields and version
+        entry, version = phonebook.entry_cache.get(entry_id)
+        self.assertEqual(entry['address'], "Disneyland")
+        self.assertEqual(entry['firstname'], "Minnie")
+        self.assertEqual(version, 2)
+        response = phonebook.app.request(uri, method='GET')
+        self.assertEqual(response.headers['ETag'], '"2"')
+        self.assertEqual(self.json_data(response.data)['address'], "Disneyland")
+
+        # Changed behind the app's back: PUT still applies and drops the stale entry
+        db.query("UPDATE phonebook SET version = 5, number = '0800123456'")
+        response = phonebook.app.request(uri, method='PUT', data='{"firstname":"Minerva"}')
+        self.assertEqual(response.status, "204 No Content")
+        self.assertEqual(phonebook.entry_cache.get(entry_id), None)
+        response = phonebook.app.request(uri, method='GET')
+        minerva = self.json_data(response.data)
+        self.assertEqual((minerva['firstname'], minerva['number']), ("Minerva", "0800123456"))
+        self.assertEqual(response.headers['ETag'], '"6"')
+
+        phonebook.app.request(uri, method='DELETE')
+        self.assertEqual(phonebook.entry_cache.get(entry_id), None)
+        response = phonebook.app.request(uri, method='GET')
+        self.assertEqual(response.status, "404 Not Found")
+
+#############################
+##   Bulk import (POST)    ##
+#############################
+
+    def test_bulk_import_ndjson(self):
+        '''Test that NDJSON rows are inserted and invalid rows reported by line'''
+        lines = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}',
+                 '',
+                 '{"surname":"Mouse","firstname":"Minnie","number":"NaN"}',
+                 'not json',
+                 '{"surname":"Duck","firstname":"Donald","number":"028384752","address":"Disneyland"}',
+                 '{"surname":"Duck","firstname":"Daisy","number":"028384752","age":3}',
+                 '{"surname":"Duck","firstname":"Huey","number":"028384752"}']
+
+        # Small batches so the import spans several transactions
+        batch_size = phonebook.BULK_BATCH_SIZE
+        phonebook.BULK_BATCH_SIZE = 2
+        try:
+            response = phonebook.app.request("/bulk", method='POST', data='\n'.join(lines),
+                                             headers={'Content-Type':'application/x-ndjson'})
+        finally:
+            phonebook.BULK_BATCH_SIZE = batch_size
+        self.assertEqual(response.status, "200 OK")
+
+        result = self.json_data(response.data)
+        self.assertEqual(result['inserted'], 3)
+        self.assertEqual(result['rejected'], 3)
+        self.assertEqual(result['errors'],
+            [{'line':3, 'error':phonebook.response_strings['invalid_number']},
+             {'line':4, 'error':phonebook.response_strings['invalid_json']},
+             {'line':6, 'error':phonebook.response_strings['unrecognized_field']}])
+
+        names = [row.firstname for row in db.select('phonebook', order='id')]
+        self.assertEqual(names, ["Mickey", "Donald", "Huey"])
+
+        # Derived columns are filled in as for a single POST
+        donald = db.where('phonebook', firstname='Donald')[0]
+        self.assertEqual(donald.surname_key, 'D200')
+        self.assertEqual(donald.number_digits, '028384752')
+
+    def test_bulk_import_field_types(self):
+        '''Test that rows with fields that aren't strings are reported, not inserted'''
+        lines = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}',
+                 '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                 '{"surname":{"x":1},"firstname":"Donald","number":"028384752"}',
+                 '{"surname":"Duck","firstname":"Daisy","number":"028384752","address":3}',
+                 '{"surname":null,"firstname":"Huey","number":"028384752"}',
+                 '{"surname":"Duck","firstname":"Dewey","number":"028384752","address":null}',
+                 '{"surname":"Duck","firstname":"Louie","number":"028384752"}']
+
+        # Small batches so the invalid rows fall between committed batches
+        batch_size = phonebook.BULK_BATCH_SIZE
+        phonebook.BULK_BATCH_SIZE = 2
+        try:
+            response = phonebook.app.request("/bulk", method='POST', data='\n'.join(lines))
+        finally:
+            phonebook.BULK_BATCH_SIZE = batch_size
+        self.assertEqual(response.status, "200 OK")
+
+        result = self.json_data(response.data)
+        self.assertEqual(result['inserted'], 4)
+        self.assertEqual(result['errors'],
+            [{'line':3, 'error':phonebook.response_strings['invalid_type']},
+             {'line':4, 'error':phonebook.response_strings['invalid_type']},
+             {'line':5, 'error':phonebook.response_strings['empty_string']}])
+        names = [row.firstname for row in db.select('phonebook', order='id')]
+        self.assertEqual(names, ["Mickey", "Minnie", "Dewey", "Louie"])
+
+    def test_bulk_import_csv(self):
+        '''Test that CSV rows with a header are inserted'''
+        data = ('surname,firstname,number,address\r\n'
+                'Mouse,Mickey,01234567789,\r\n'
+                'Mouse,Minnie,02045679920,"12 New Road, Disneyland"\r\n'
+                'Duck,Donald\r\n')
+        response = phonebook.app.request("/bulk", method='POST', data=data,
+                                         headers={'Content-Type':'text/csv; charset=utf-8'})
+        result = self.json_data(response.data)
+        self.assertEqual(result['inserted'], 2)
+        self.assertEqual(result['errors'],
+            [{'line':4, 'error':phonebook.response_strings['missing_field']}])
+
+        mickey = db.where('phonebook', firstname='Mickey')[0]
+        self.assertEqual(mickey.address, None)
+        minnie = db.where('phonebook', firstname='Minnie')[0]
+        self.assertEqual(minnie.address, "12 New Road, Disneyland")
+
 #############################
 ##      List (GET)         ##
 #############################
@@ -184,6 +334,128 @@ class TestPhonebook(unittest.TestCase):
 
         self.assertEqual(len(json_resp), 4)
 
+    def test_list_paginated(self):
+        '''Test that listing is split into pages linked by the next cursor'''
+
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920","address":"12 New Road, Disneyland"}',
+                '{"surname":"Duck","firstname":"Donald","number":"028384752","address":"123a Main Street, Disneyland"}']
+
+        for entry in data:
+            response = phonebook.app.request("/", method='POST', data=entry)
+
+        # First page holds two entries and links to the next page
+        response = phonebook.app.request("/?limit=2", method='GET')
+        self.assertEqual(response.status, "200 OK")
+        first_page = self.json_data(response.data)
+        self.assertEqual(len(first_page), 2)
+        self.assertTrue(first_page[0]['id'] < first_page[1]['id'])
+
+        link = response.headers['Link']
+        self.assertEqual(link, '</?limit=2&after=%d>; rel="next"' % first_page[1]['id'])
+
+        # Last page holds the remaining entry and has no next link
+        next_uri = link[1:link.index('>')]
+        response = phonebook.app.request(next_uri, method='GET')
+        last_page = self.json_data(response.data)
+        self.assertEqual(len(last_page), 1)
+        self.assertEqual(last_page[0]['firstname'], "Donald")
+        self.assertFalse('Link' in response.headers)
+
+    def test_list_stream(self):
+        '''Test that streaming returns every entry as one JSON array'''
+
+        response = phonebook.app.request("/?stream=1", method='GET')
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(self.json_data(response.data), [])
+
+        for i in range(5):
+            entry = '{"surname":"Mouse","firstname":"Mickey%d","number":"01234567789"}' % i
+            phonebook.app.request("/", method='POST', data=entry)
+
+        # Use a small batch size so the entries span several batches
+        batch_size = phonebook.STREAM_BATCH_SIZE
+        phonebook.STREAM_BATCH_SIZE = 2
+        try:
+            response = phonebook.app.request("/?stream=1", method='GET')
+        finally:
+            phonebook.STREAM_BATCH_SIZE = batch_size
+        self.assertEqual(response.status, "200 OK")
+
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results],
+                         ['Mickey%d' % i for i in range(5)])
+        self.assertFalse('Link' in response.headers)
+
+    def test_list_invalid_page_params(self):
+        '''Test that bad limit or cursor values return 400 Bad request'''
+
+        for uri in ["/?limit=0", "/?limit=abc", "/?limit=%d" % (phonebook.MAX_PAGE_SIZE + 1)]:
+            response = phonebook.app.request(uri, method='GET')
+            self.assertEqual(response.status, "400 Bad Request")
+            self.assertEqual(response.data, phonebook.response_strings['invalid_limit'])
+
+        response = phonebook.app.request("/?after=-1", method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['invalid_cursor'])
+
+#############################
+##     Export (GET)        ##
+#############################
+
+    def add_export_data(self):
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920","address":"12 New Road, Disneyland"}',
+                '{"surname":"Duck","firstname":"Donald","number":"028384752","address":"123a Main Street, Disneyland"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+    def test_export_ndjson(self):
+        '''Test that NDJSON export has one entry per line'''
+        self.add_export_data()
+        batch_size = phonebook.STREAM_BATCH_SIZE
+        phonebook.STREAM_BATCH_SIZE = 2
+        try:
+            response = phonebook.app.request("/export", method='GET')
+        finally:
+            phonebook.STREAM_BATCH_SIZE = batch_size
+        self.assertEqual(response.status, "200 OK")
+        self.assertEqual(response.headers['Content-Type'], 'application/x-ndjson')
+
+        lines = response.data.splitlines()
+        entries = [self.json_data(line) for line in lines]
+        self.assertEqual([e['firstname'] for e in entries], ["Mickey", "Minnie", "Donald"])
+
+    def test_export_csv(self):
+        '''Test that CSV export has a header row and one row per entry'''
+        self.add_export_data()
+        response = phonebook.app.request("/export?format=csv", method='GET')
+        self.assertEqual(response.status, "200 OK")
+
+        rows = list(csv.DictReader(response.data.splitlines()))
+        self.assertEqual([r['firstname'] for r in rows], ["Mickey", "Minnie", "Donald"])
+        self.assertEqual(rows[0]['address'], '')
+        self.assertEqual(rows[1]['address'], "12 New Road, Disneyland")
+
+    def test_export_gzip(self):
+        '''Test that export is gzip-compressed when the client accepts gzip'''
+        self.add_export_data()
+        response = phonebook.app.request("/export", method='GET',
+                                         headers={'Accept-Encoding':'deflate, gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        data = zlib.decompress(response.data, 16 + zlib.MAX_WBITS)
+        self.assertEqual(len(data.splitlines()), 3)
+
+        response = phonebook.app.request("/export", method='GET',
+                                         headers={'Accept-Encoding':'gzip;q=0'})
+        self.assertFalse('Content-Encoding' in response.headers)
+
+    def test_export_bad_format(self):
+        '''Test that an unknown export format is a 400 Bad request'''
+        response = phonebook.app.request("/export?format=xml", method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['invalid_format'])
+
 #############################
 ##      Update (PUT)       ##
 #############################
@@ -388,6 +660,31 @@ class TestPhonebook(unittest.TestCase):
         self.assertEqual(response.status, "400 Bad Request")
         self.assertEqual(response.data, phonebook.response_strings['invalid_json'])
 
+    def test_update_if_match(self):
+        '''Test that If-Match only updates the entry version it names'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+
+        response = phonebook.app.request(uri, method='PUT', data='{"firstname":"Minerva"}',
+                                         headers={'If-Match':'"1"'})
+        self.assertEqual(response.status, "204 No Content")
+        self.assertEqual(db.where('phonebook', id=uri[1:])[0].version, 2)
+
+        # Version 1 is now stale
+        response = phonebook.app.request(uri, method='PUT', data='{"firstname":"Min"}',
+                                         headers={'If-Match':'"1"'})
+        self.assertEqual(response.status, "412 Precondition Failed")
+        self.assertEqual(response.data, phonebook.response_strings['version_mismatch'])
+        self.assertEqual(db.where('phonebook', id=uri[1:])[0].firstname, "Minerva")
+
+        response = phonebook.app.request(uri, method='PUT', data='{"firstname":"Min"}',
+                                         headers={'If-Match':'"1", "2"'})
+        self.assertEqual(response.status, "204 No Content")
+
+        response = phonebook.app.request("/10", method='PUT', data='{"firstname":"Min"}',
+                                         headers={'If-Match':'"1"'})
+        self.assertEqual(response.status, "404 Not Found")
+
 #############################
 ##    Delete (DELETE)      ##
 #############################
@@ -420,6 +717,88 @@ class TestPhonebook(unittest.TestCase):
         response = phonebook.app.request('/10', method='DELETE')
         self.assertEqual(response.status, "404 Not Found")
 
+    def test_id_out_of_range(self):
+        '''Test that ids too large for SQLite are not found'''
+        uri = '/%d' % 2**64
+        self.assertEqual(phonebook.app.request(uri).status, "404 Not Found")
+        response = phonebook.app.request(uri, method='PUT', data='{"firstname":"Minerva"}')
+        self.assertEqual(response.status, "404 Not Found")
+        self.assertEqual(phonebook.app.request(uri, method='DELETE').status, "404 Not Found")
+        response = phonebook.app.request('/batch', method='POST',
+                                         data='[{"op":"delete", "id":%d}]' % 2**64)
+        self.assertEqual(self.json_data(response.data)[0]['status'], 404)
+
+    def test_delete_if_match(self):
+        '''Test that If-Match only deletes the entry version it names'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+        phonebook.app.request(uri, method='PUT', data='{"firstname":"Minerva"}')
+
+        response = phonebook.app.request(uri, method='DELETE', headers={'If-Match':'"1"'})
+        self.assertEqual(response.status, "412 Precondition Failed")
+        self.assertEqual(len(db.where('phonebook', id=uri[1:]).list()), 1)
+
+        response = phonebook.app.request(uri, method='DELETE', headers={'If-Match':'"2"'})
+        self.assertEqual(response.status, "204 No Content")
+        self.assertEqual(len(db.where('phonebook', id=uri[1:]).list()), 0)
+
+#############################
+##    Batch (POST)         ##
+#############################
+
+    def test_batch(self):
+        '''Test a mix of updates and deletes applied in one request'''
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"Duck","firstname":"Donald","number":"028384752"}',
+                '{"surname":"Duck","firstname":"Daisy","number":"028384752"}']
+        ids = [int(self.get_loc(phonebook.app.request("/", method='POST', data=entry))[1:])
+               for entry in data]
+
+        operations = [{"op":"update", "id":ids[0], "data":{"address":"Disneyland"}},
+                      {"op":"delete", "id":ids[1]},
+                      {"op":"update", "id":ids[2], "data":{"address":"Disneyland"}},
+                      {"op":"update", "id":ids[3], "data":{"surname":"Smyth"}},
+                      {"op":"delete", "id":ids[3] + 100}]
+        response = phonebook.app.request("/batch", method='POST', data=json.dumps(operations))
+        self.assertEqual(response.status, "200 OK")
+
+        results = self.json_data(response.data)
+        self.assertEqual([r['id'] for r in results], [op['id'] for op in operations])
+        self.assertEqual([r['status'] for r in results], [204, 204, 204, 204, 404])
+
+        rows = dict([(row.id, row) for row in db.select('phonebook')])
+        self.assertEqual(sorted(rows.keys()), [ids[0], ids[2], ids[3]])
+        self.assertEqual(rows[ids[0]].address, "Disneyland")
+        self.assertEqual(rows[ids[2]].address, "Disneyland")
+        self.assertEqual(rows[ids[3]].surname, "Smyth")
+        # Derived columns follow batch updates
+        self.assertEqual(rows[ids[3]].surname_key, "S530")
+
+    def test_batch_invalid_operations(self):
+        '''Test that invalid operations are reported without stopping the rest'''
+        uri = self.get_loc(phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}'))
+        entry_id = int(uri[1:])
+
+        operations = [{"op":"insert", "id":entry_id},
+                      {"op":"update", "id":entry_id, "data":{"number":"NaN"}},
+                      {"op":"update", "id":entry_id, "data":{}},
+                      {"op":"update", "id":entry_id, "data":{"firstname":"Minnie"}},
+                      {"op":"delete", "id":entry_id},
+                      "delete"]
+        response = phonebook.app.request("/batch", method='POST', data=json.dumps(operations))
+        results = self.json_data(response.data)
+        self.assertEqual([r['status'] for r in results], [400, 400, 400, 204, 400, 400])
+        self.assertEqual(results[1]['error'], phonebook.response_strings['invalid_number'])
+        self.assertEqual(results[2]['error'], phonebook.response_strings['update_fields'])
+        self.assertEqual(results[4]['error'], phonebook.response_strings['duplicate_operation'])
+
+        self.assertEqual(db.select('phonebook')[0].firstname, "Minnie")
+
+        response = phonebook.app.request("/batch", method='POST', data='{"op":"delete"}')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['invalid_batch'])
 
 #############################
 ##      Search (GET)       ##
@@ -483,6 +862,838 @@ class TestPhonebook(unittest.TestCase):
         self.assertEqual(len(results), 0)
 
 
+    def test_search_ignores_case(self):
+        '''Test that surname search matches regardless of case'''
+        data = ['{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"MOUSE","firstname":"Mickey","number":"01234567789"}',
+                '{"surname":"Mousetrap","firstname":"Tom","number":"01234567789"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/mouse', method='GET')
+        self.assertEqual(response.status, "200 OK")
+
+        # Ordered by firstname within the surname
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results], ["Mickey", "Minnie"])
+
+    def test_search_prefix(self):
+        '''Test that a trailing * or ?match=prefix finds surnames by prefix'''
+        data = ['{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"mousetrap","firstname":"Tom","number":"01234567789"}',
+                '{"surname":"Moz","firstname":"Zed","number":"01234567789"}',
+                '{"surname":"Duck","firstname":"Donald","number":"028384752"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/MOU*', method='GET')
+        self.assertEqual(response.status, "200 OK")
+        results = self.json_data(response.data)
+        self.assertEqual([r['surname'] for r in results], ["Mouse", "mousetrap"])
+
+        response = phonebook.app.request('/mo?match=prefix', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual(len(results), 3)
+
+        # Prefix ending in Z must still match lowercase z
+        response = phonebook.app.request('/MoZ*', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual([r['surname'] for r in results], ["Moz"])
+
+    def test_search_bad_match(self):
+        '''Test that an unknown match mode or empty prefix is a 400 Bad request'''
+        response = phonebook.app.request('/Mouse?match=fuzzy', method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['invalid_match'])
+
+        response = phonebook.app.request('/*', method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['empty_prefix'])
+
+    def test_search_uses_index(self):
+        '''Test that exact and prefix searches are answered from the surname index'''
+        for match in ['exact', 'prefix']:
+            where, vars = phonebook.surname_clause(match, 'Mou')
+            plan = db.query('EXPLAIN QUERY PLAN SELECT * FROM phonebook WHERE ' + where,
+                            vars=vars)
+            detail = ' '.join([row.detail for row in plan])
+            # SEARCH (rather than SCAN) means an index lookup or range scan
+            self.assertTrue(detail.startswith('SEARCH'), detail)
+            self.assertTrue('phonebook_surname_firstname' in detail, detail)
+
+    def test_search_phonetic(self):
+        '''Test that ?match=phonetic finds surnames that sound alike'''
+        data = ['{"surname":"Smith","firstname":"John","number":"01234567789"}',
+                '{"surname":"Smythe","firstname":"Jane","number":"02045679920"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/Smyth?match=phonetic', method='GET')
+        self.assertEqual(response.status, "200 OK")
+        results = self.json_data(response.data)
+        self.assertEqual([r['surname'] for r in results], ["Smith", "Smythe"])
+
+        # The phonetic key follows surname updates
+        uri = self.get_loc(phonebook.app.request("/", method='POST',
+            data='{"surname":"Duck","firstname":"Donald","number":"028384752"}'))
+        phonebook.app.request(uri, method='PUT', data='{"surname":"Mous"}')
+        response = phonebook.app.request('/Mouse?match=phonetic', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual(sorted([r['firstname'] for r in results]), ["Donald", "Minnie"])
+
+    def test_phonetic_key_backfill(self):
+        '''Test that init_schema fills in phonetic keys for existing entries'''
+        db.insert('phonebook', surname='Smith', firstname='John', number='01234567789')
+        self.assertEqual(db.select('phonebook')[0].surname_key, None)
+
+        phonebook.init_schema(db)
+        self.assertEqual(db.select('phonebook')[0].surname_key, 'S530')
+
+    def test_soundex(self):
+        '''Test Soundex codes against the standard examples'''
+        examples = {'Robert':'R163', 'Rupert':'R163', 'Ashcraft':'A261',
+                    'Tymczak':'T522', 'Pfister':'P236', 'Lee':'L000'}
+        for name, code in examples.items():
+            self.assertEqual(phonebook.soundex(name), code)
+        self.assertEqual(phonebook.soundex('123'), None)
+        self.assertEqual(phonebook.soundex(''), None)
+        self.assertEqual(phonebook.soundex(None), None)
+
+    def test_phonetic_null_surname(self):
+        '''Test that entries without a surname are not found by phonetic search'''
+        db.insert('phonebook', firstname='John', number='01234567789',
+                  **phonebook.derived_fields({'surname':None}))
+        phonebook.init_schema(db)
+        self.assertEqual(db.select('phonebook')[0].surname_key, None)
+        response = phonebook.app.request('/Newman?match=phonetic', method='GET')
+        self.assertEqual(self.json_data(response.data), [])
+
+#############################
+##   Search caching        ##
+#############################
+
+    def search(self, uri):
+        return [r['firstname'] for r in
+                self.json_data(phonebook.app.request(uri, method='GET').data)]
+
+    def test_search_cache_hits(self):
+        '''Test that repeated searches are served from the cache'''
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+
+        stats = phonebook.search_cache.stats()
+        self.assertEqual(self.search('/Mouse'), ["Minnie"])
+        # Same search in another case shares the cached response
+        self.assertEqual(self.search('/mouse'), ["Minnie"])
+
+        response = phonebook.app.request('/_stats', method='GET')
+        new_stats = self.json_data(response.data)['search_cache']
+        self.assertEqual(new_stats['misses'], stats['misses'] + 1)
+        self.assertEqual(new_stats['hits'], stats['hits'] + 1)
+
+        # Changed behind the app's back, so the cached response is served
+        db.query("UPDATE phonebook SET firstname='Minerva'")
+        self.assertEqual(self.search('/Mouse'), ["Minnie"])
+
+    def test_search_cache_invalidation(self):
+        '''Test that writes drop the cached searches they affect'''
+        uri = self.get_loc(phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'))
+        self.assertEqual(self.search('/Mouse'), ["Minnie"])
+        self.assertEqual(self.search('/Mo*'), ["Minnie"])
+        self.assertEqual(self.search('/Mous?match=phonetic'), ["Minnie"])
+        self.assertEqual(self.search('/Duck'), [])
+
+        # Adding an entry refreshes searches for its surname
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Mickey","number":"01234567789"}')
+        self.assertEqual(self.search('/Mouse'), ["Mickey", "Minnie"])
+        self.assertEqual(self.search('/Mo*'), ["Mickey", "Minnie"])
+        self.assertEqual(self.search('/Mous?match=phonetic'), ["Mickey", "Minnie"])
+
+        # Updating an entry refreshes searches listing it and for its new surname
+        phonebook.app.request(uri, method='PUT', data='{"firstname":"Minerva"}')
+        self.assertEqual(self.search('/Mouse'), ["Mickey", "Minerva"])
+        phonebook.app.request(uri, method='PUT', data='{"surname":"Duck"}')
+        self.assertEqual(self.search('/Mouse'), ["Mickey"])
+        self.assertEqual(self.search('/Duck'), ["Minerva"])
+
+        # Deleting an entry refreshes searches listing it
+        phonebook.app.request(uri, method='DELETE')
+        self.assertEqual(self.search('/Duck'), [])
+
+    def test_search_cache_eviction(self):
+        '''Test that the cache holds at most maxsize responses'''
+        cache = phonebook.SearchCache(2)
+        cache.put('a', 'A', [1], cache.generation)
+        cache.put('b', 'B', [2], cache.generation)
+        self.assertEqual(cache.get('a'), 'A')
+        # A miss, as before every put
+        cache.get('c')
+        cache.put('c', 'C', [1], cache.generation)
+        # b was least recently used
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(sorted(cache.keys_by_id[1]), ['a', 'c'])
+        self.assertFalse(2 in cache.keys_by_id)
+
+        # A response read before an invalidation is not cached
+        generation = cache.generation
+        cache.invalidate(ids=[1])
+        self.assertEqual(cache.stats()['size'], 0)
+        cache.put('a', 'A', [1], generation)
+        self.assertEqual(cache.get('a'), None)
+
+    def test_search_cache_admission(self):
+        '''Test that a scan over rarely searched keys keeps popular keys cached'''
+        cache = phonebook.SearchCache(4)
+        for key in ['a', 'b', 'c', 'd']:
+            for i in range(3):
+                if cache.get(key) is None:
+                    cache.put(key, key.upper(), [], cache.generation)
+        for i in range(20):
+            key = 'scan%d' % i
+            if cache.get(key) is None:
+                cache.put(key, key.upper(), [], cache.generation)
+        self.assertEqual(sorted(cache.items.keys()), ['a', 'b', 'c', 'd'])
+        self.assertEqual(cache.stats()['rejected'], 20)
+
+        # A key searched for more often than the least recently used one
+        # gets in
+        cache.get('e'); cache.get('e'); cache.get('e'); cache.get('e')
+        cache.put('e', 'E', [], cache.generation)
+        self.assertEqual(cache.get('e'), 'E')
+        self.assertEqual(cache.stats()['size'], 4)
+
+    def test_frequency_sketch_ages(self):
+        '''Test that sketch counts are halved after each sample period'''
+        sketch = phonebook.FrequencySketch(4)
+        for i in range(8):
+            sketch.add('a')
+        self.assertEqual(sketch.estimate('a'), 8)
+        self.assertEqual(sketch.estimate('b'), 0)
+        for i in range(sketch.sample_size - 8):
+            sketch.add(i)
+        self.assertTrue(sketch.estimate('a') <= 5, sketch.estimate('a'))
+
+    def test_etag_not_modified(self):
+        '''Test that listing and search return 304 until the data changes'''
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+
+        for uri in ['/', '/Mouse']:
+            response = phonebook.app.request(uri, method='GET')
+            self.assertEqual(response.status, "200 OK")
+            etag = response.headers['ETag']
+
+            response = phonebook.app.request(uri, method='GET', headers={'If-None-Match':etag})
+            self.assertEqual(response.status, "304 Not Modified")
+            self.assertEqual(response.data, "")
+
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Duck","firstname":"Donald","number":"028384752"}')
+
+        response = phonebook.app.request('/', method='GET', headers={'If-None-Match':etag})
+        self.assertEqual(response.status, "200 OK")
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertEqual(len(self.json_data(response.data)), 2)
+
+    def test_page_cache(self):
+        '''Test that listing pages are cached until the next write'''
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+        phonebook.app.request('/?limit=10', method='GET')
+        hits = phonebook.page_cache.stats()['hits']
+        response = phonebook.app.request('/?limit=10', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 1)
+        self.assertEqual(phonebook.page_cache.stats()['hits'], hits + 1)
+
+        phonebook.app.request("/", method='POST',
+            data='{"surname":"Duck","firstname":"Donald","number":"028384752"}')
+        response = phonebook.app.request('/?limit=10', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 2)
+        self.assertEqual(phonebook.page_cache.stats()['hits'], hits + 1)
+
+    def test_cache_snapshot(self):
+        '''Test that caches warmed from a snapshot serve its searches and pages'''
+        data = ['{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"Smyth","firstname":"Jane","number":"028384752"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+        uris = ['/Mouse', '/mo*', '/Smith?match=phonetic', '/Nobody?match=phonetic', '/?limit=5']
+        responses = [phonebook.app.request(uri, method='GET').data for uri in uris]
+
+        path = 'test_cache_snapshot.json'
+        phonebook.save_cache_snapshot(path)
+        try:
+            phonebook.search_cache.clear()
+            phonebook.page_cache.clear()
+            phonebook.warm_caches(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(phonebook.search_cache.stats()['size'], 3)
+        self.assertEqual(phonebook.page_cache.stats()['size'], 1)
+
+        hits = phonebook.search_cache.stats()['hits'] + phonebook.page_cache.stats()['hits']
+        for uri, expected in zip(uris, responses):
+            self.assertEqual(phonebook.app.request(uri, method='GET').data, expected)
+        self.assertEqual(phonebook.search_cache.stats()['hits'] +
+                         phonebook.page_cache.stats()['hits'], hits + 4)
+
+        # A missing snapshot leaves the caches as they are
+        phonebook.warm_caches(path)
+
+    def test_cache_snapshot_invalid(self):
+        '''Test that invalid entries in a snapshot are skipped, not fatal'''
+        phonebook.app.request("/", method='POST',
+                              data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+        path = 'test_cache_snapshot.json'
+        with open(path, 'w') as f:
+            json.dump({'searches':[['prefix', ''], ['soundalike', 'Mouse'], 'Mouse',
+                                   [None, None], ['exact', 'Mouse']],
+                       'pages':[[0, 0], [-1, 5], ['a', 5], [0, 5, 1], [0, 5]]}, f)
+        try:
+            phonebook.warm_caches(path)
+        finally:
+            os.remove(path)
+        self.assertEqual(phonebook.search_cache.stats()['size'], 1)
+        self.assertEqual(phonebook.page_cache.stats()['size'], 1)
+
+    def test_single_flight_shares_result(self):
+        '''Test that concurrent calls for one key share a single computation'''
+        flight = phonebook.SingleFlight()
+        release = threading.Event()
+        calls = []
+        def compute():
+            calls.append(1)
+            release.wait()
+            return 'result'
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flight.do('key', compute)))
+                   for i in range(4)]
+        for thread in threads:
+            thread.start()
+        # Wait until one thread is computing and the rest are waiting on it
+        while flight.stats()['shared'] < 3:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, ['result'] * 4)
+        self.assertEqual(flight.stats(), {'in_flight':0, 'computed':1, 'shared':3})
+
+        # Once finished, the next call for the key computes afresh
+        self.assertEqual(flight.do('key', lambda: 'again'), 'again')
+
+    def test_single_flight_shares_error(self):
+        '''Test that waiting callers see the exception of the call they shared'''
+        flight = phonebook.SingleFlight()
+        release = threading.Event()
+        def compute():
+            release.wait()
+            raise KeyError('failed')
+
+        errors = []
+        def call():
+            try:
+                flight.do('key', compute)
+            except KeyError, e:
+                errors.append(e)
+        threads = [threading.Thread(target=call) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        while flight.stats()['shared'] < 1:
+            time.sleep(0.001)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(errors), 2)
+
+#############################
+##   Number lookup (GET)   ##
+#############################
+
+    def test_number_lookup(self):
+        '''Test reverse lookup by number, ignoring formatting characters'''
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"0123 456-7789"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"Duck","firstname":"Donald","number":"0204 111 222#3"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/number/01234567789', method='GET')
+        self.assertEqual(response.status, "200 OK")
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results], ["Mickey"])
+        # The number is returned as it was entered
+        self.assertEqual(results[0]['number'], "0123 456-7789")
+
+        response = phonebook.app.request('/number/0204', method='GET')
+        self.assertEqual(self.json_data(response.data), [])
+
+    def test_number_prefix_lookup(self):
+        '''Test area code lookups with a trailing * or ?match=prefix'''
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"0123 456-7789"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}',
+                '{"surname":"Duck","firstname":"Donald","number":"0204 111 222#3"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/number/0204*', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results], ["Donald", "Minnie"])
+
+        response = phonebook.app.request('/number/0204?match=prefix&limit=1', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results], ["Donald"])
+
+        response = phonebook.app.request('/number/0204?match=fuzzy', method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['invalid_number_match'])
+
+    def test_number_lookup_follows_updates(self):
+        '''Test that the normalized number follows number updates'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+        phonebook.app.request(uri, method='PUT', data='{"number":"0800-123-456"}')
+
+        response = phonebook.app.request('/number/0800123456', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 1)
+        response = phonebook.app.request('/number/02045679920', method='GET')
+        self.assertEqual(self.json_data(response.data), [])
+
+#############################
+##   Full-text search      ##
+#############################
+
+    def test_fulltext_search(self):
+        '''Test that free-text search finds entries by name and address words'''
+        data = ['{"surname":"Mouse","firstname":"Mickey","number":"01234567789","address":"1 Disneyland Road"}',
+                '{"surname":"Mouse","firstname":"Minnie","number":"02045679920","address":"12 New Road, Disneyland"}',
+                '{"surname":"Duck","firstname":"Donald","number":"028384752","address":"123a Main Street, Disneyland"}']
+        for entry in data:
+            phonebook.app.request("/", method='POST', data=entry)
+
+        response = phonebook.app.request('/search?q=disneyland+road', method='GET')
+        self.assertEqual(response.status, "200 OK")
+        results = self.json_data(response.data)
+        self.assertEqual(sorted([r['firstname'] for r in results]), ["Mickey", "Minnie"])
+
+        response = phonebook.app.request('/search?q=donald', method='GET')
+        results = self.json_data(response.data)
+        self.assertEqual([r['firstname'] for r in results], ["Donald"])
+
+        # Punctuation in the query is not treated as FTS syntax
+        response = phonebook.app.request('/search?q=%22main%22+OR+(street', method='GET')
+        self.assertEqual(response.status, "200 OK")
+
+    def test_fulltext_follows_updates(self):
+        '''Test that the full-text index reflects updated and deleted entries'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920","address":"12 New Road, Disneyland"}'
+        response = phonebook.app.request("/", method='POST', data=original)
+        uri = self.get_loc(response)
+
+        phonebook.app.request(uri, method='PUT', data='{"address":"13 Other Lane, Toontown"}')
+        response = phonebook.app.request('/search?q=disneyland', method='GET')
+        self.assertEqual(self.json_data(response.data), [])
+        response = phonebook.app.request('/search?q=toontown', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 1)
+
+        phonebook.app.request(uri, method='DELETE')
+        response = phonebook.app.request('/search?q=toontown', method='GET')
+        self.assertEqual(self.json_data(response.data), [])
+
+    def test_fulltext_empty_query(self):
+        '''Test that a query with no words is a 400 Bad request'''
+        response = phonebook.app.request('/search?q=+!', method='GET')
+        self.assertEqual(response.status, "400 Bad Request")
+        self.assertEqual(response.data, phonebook.response_strings['empty_query'])
+
+#############################
+##   Stored JSON           ##
+#############################
+
+    def test_stored_json_follows_writes(self):
+        '''Test that the stored JSON of an entry is kept up to date on writes'''
+        original = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920","address":"12 New Road, Disneyland"}'
+        uri = self.get_loc(phonebook.app.request("/", method='POST', data=original))
+        id = int(uri.rsplit('/', 1)[1])
+        stored = json.loads(db.select('phonebook', where='id=$id', vars={'id':id})[0].json)
+        self.assertEqual(stored, dict(json.loads(original), id=id))
+
+        phonebook.app.request(uri, method='PUT', data='{"number":"0800-123-456"}')
+        stored = json.loads(db.select('phonebook', where='id=$id', vars={'id':id})[0].json)
+        self.assertEqual(stored['number'], "0800-123-456")
+
+    def test_listing_uses_stored_json(self):
+        '''Test that listings are assembled from the stored JSON'''
+        phonebook.app.request("/", method='POST',
+                              data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+        db.update('phonebook', where='1=1', json='{"stored":true}')
+
+        for uri in ['/', '/?stream=1', '/Mouse', '/number/02045679920']:
+            response = phonebook.app.request(uri, method='GET')
+            self.assertEqual(self.json_data(response.data), [{"stored":True}])
+
+    def test_stored_json_backfill(self):
+        '''Test that init_schema fills in the stored JSON for existing entries'''
+        phonebook.app.request("/", method='POST',
+                              data='{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}')
+        db.update('phonebook', where='1=1', json=None)
+
+        phonebook.init_schema(db)
+        stored = json.loads(db.select('phonebook')[0].json)
+        self.assertEqual(stored['firstname'], "Minnie")
+        self.assertEqual(stored['address'], None)
+
+#############################
+##   In-memory reads       ##
+#############################
+
+    memory_data = ['{"surname":"Mouse","firstname":"Mickey","number":"01234 567789"}',
+                   '{"surname":"mouser","firstname":"Minnie","number":"02045679920"}',
+                   '{"surname":"Smith","firstname":"John","number":"0204-111","address":"1 Road"}',
+                   '{"surname":"Smyth","firstname":"Jane","number":"028384752"}',
+                   '{"surname":"Duck","firstname":"Donald","number":"028384753"}']
+
+    def memory_uris(self, ids):
+        return ['/', '/?limit=2', '/?limit=2&after=%d' % ids[1], '/Mouse', '/MOUSE',
+                '/mou*', '/Sm?match=prefix', '/Smith?match=phonetic', '/Nobody',
+                '/number/02045679920', '/number/0204*', '/number/028384*?limit=1',
+                '/number/9', '/%d' % ids[2], '/%d' % (ids[-1] + 1),
+                '/None', '/Non*', '/Nan?match=phonetic', '/%d' % ids[-1]]
+
+    def test_memory_index_matches_database(self):
+        '''Test that reads served from memory match those from the database'''
+        ids = [int(self.get_loc(phonebook.app.request("/", method='POST', data=entry))[1:])
+               for entry in self.memory_data]
+        # Entries written before surnames were required may have none
+        ids.append(db.insert('phonebook', seqname='id', **phonebook.entry_row(
+            {'surname':None, 'firstname':'Nora', 'number':'020700'})))
+
+        def responses():
+            phonebook.search_cache.clear()
+            phonebook.entry_cache.clear()
+            return [(r.status, r.headers.get('Link'), r.data) for r in
+                    [phonebook.app.request(uri, method='GET') for uri in self.memory_uris(ids)]]
+
+        from_database = responses()
+        phonebook.memory_index = phonebook.MemoryIndex(db)
+        from_memory = responses()
+        for uri, expected, actual in zip(self.memory_uris(ids), from_database, from_memory):
+            self.assertEqual(actual[:2], expected[:2], uri)
+            if expected[0] == "200 OK":
+                self.assertEqual(self.json_data(actual[2]), self.json_data(expected[2]), uri)
+
+    def test_memory_index_write_through(self):
+        '''Test that writes reach both the database and the in-memory index'''
+        phonebook.memory_index = phonebook.MemoryIndex(db)
+        ids = [int(self.get_loc(phonebook.app.request("/", method='POST', data=entry))[1:])
+               for entry in self.memory_data]
+        phonebook.app.request('/%d' % ids[0], method='PUT',
+                              data='{"surname":"Duck","number":"028384754"}')
+        phonebook.app.request('/%d' % ids[1], method='DELETE')
+        phonebook.app.request("/batch", method='POST',
+                              data=json.dumps([{"op":"delete", "id":ids[2]}]))
+        phonebook.app.request("/bulk", method='POST',
+                              data='{"surname":"Mouse","firstname":"Morty","number":"020500"}')
+
+        in_memory = phonebook.memory_index.page(0, 100)
+        self.assertEqual(sorted([e.id for e in in_memory]),
+                         sorted([row.id for row in db.select('phonebook')]))
+
+        response = phonebook.app.request('/Duck', method='GET')
+        self.assertEqual([e['firstname'] for e in self.json_data(response.data)], ["Donald", "Mickey"])
+        response = phonebook.app.request('/mou*', method='GET')
+        self.assertEqual([e['firstname'] for e in self.json_data(response.data)], ["Morty"])
+        response = phonebook.app.request('/number/02838475*', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 3)
+        self.assertEqual(phonebook.memory_index.search('phonetic', 'Smith')[0].firstname, "Jane")
+
+        # Rows written behind the app's back are not seen until reloaded
+        db.insert('phonebook', surname='Mouse', firstname='Mickey', number='01234567789')
+        response = phonebook.app.request('/?limit=100', method='GET')
+        self.assertEqual(len(self.json_data(response.data)), 4)
+
+#############################
+##   Connection pool       ##
+#############################
+
+    def test_pool_concurrent_requests(self):
+        '''Test that concurrent reads and writes share the pooled connections'''
+        errors = []
+        def client(n):
+            try:
+                for i in range(10):
+                    surname = 'Mouse' + 'abcdefgh'[n]
+                    data = '{"surname":"%s","firstname":"Minnie","number":"02045679920"}' % surname
+                    response = phonebook.app.request("/", method='POST', data=data)
+                    self.assertEqual(response.status, "201 Created")
+                    response = phonebook.app.request(self.get_loc(response), method='GET')
+                    self.assertEqual(response.status, "200 OK")
+                    response = phonebook.app.request('/' + surname, method='GET')
+                    self.assertEqual(len(self.json_data(response.data)), i + 1)
+            except Exception, e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(db.query('SELECT count(*) AS n FROM phonebook')[0].n, 80)
+
+        stats = db.pool.stats()
+        self.assertTrue(stats.readers <= stats.max_readers, stats)
+        self.assertEqual(stats.idle_readers, stats.readers)
+        self.assertFalse(stats.writer_busy)
+
+    def test_pool_transaction_holds_writer(self):
+        '''Test that a transaction reads its own writes and holds the writer until it ends'''
+        with db.transaction():
+            db.insert('phonebook', surname='Mouse', firstname='Minnie', number='02045679920')
+            self.assertTrue(db.pool.stats().writer_busy)
+            self.assertEqual(len(db.select('phonebook').list()), 1)
+        self.assertFalse(db.pool.stats().writer_busy)
+
+        try:
+            with db.transaction():
+                db.insert('phonebook', surname='Duck', firstname='Donald', number='028384752')
+                raise KeyError
+        except KeyError:
+            pass
+        self.assertFalse(db.pool.stats().writer_busy)
+        self.assertEqual(len(db.select('phonebook').list()), 1)
+
+    def test_group_commit(self):
+        '''Test that concurrent writes are committed together and all become durable'''
+        grouped = web.database(dbn="sqlite", db="test_phonebook.db", profile="performance",
+                               pool=4, group_commit=0.05)
+        phonebook.db = grouped
+        try:
+            def client(n):
+                data = '{"surname":"Mouse","firstname":"Minnie","number":"0204567992%d"}' % n
+                response = phonebook.app.request("/", method='POST', data=data)
+                self.assertEqual(response.status, "201 Created")
+            threads = [threading.Thread(target=client, args=(n,)) for n in range(10)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            phonebook.db = db
+        self.assertEqual(db.query('SELECT count(*) AS n FROM phonebook')[0].n, 10)
+        self.assertTrue(grouped.pool.stats().commits < 10, grouped.pool.stats())
+
+    def test_group_commit_rollback(self):
+        '''Test that a rolled back write leaves the others in its group to be committed'''
+        grouped = web.database(dbn="sqlite", db="test_phonebook.db", profile="performance",
+                               pool=4, group_commit=0.2)
+        writer = threading.Thread(target=lambda: grouped.insert(
+            'phonebook', surname='Mouse', firstname='Minnie', number='02045679920'))
+        writer.start()
+        while not grouped.pool.batch or not grouped.pool.batch.writes:
+            time.sleep(0.001)
+        try:
+            with grouped.transaction():
+                grouped.insert('phonebook', surname='Duck', firstname='Donald', number='028384752')
+                raise KeyError
+        except KeyError:
+            pass
+        writer.join()
+        self.assertEqual([row.surname for row in db.select('phonebook')], ['Mouse'])
+
+    def test_request_transaction(self):
+        '''Test that a write request's changes commit together, with cached
+        responses dropped only after the commit'''
+        web.ctx.method, web.ctx.path, web.ctx.headers, web.ctx.data = 'POST', '/batch', [], ''
+        def handler():
+            version = phonebook.data_version
+            ids = [db.insert('phonebook', surname=surname, firstname='Minnie', number='02045679920')
+                   for surname in ('Mouse', 'Duck')]
+            phonebook.entries_changed(ids=ids)
+            self.assertEqual(phonebook.data_version, version)
+            return 'done'
+        version = phonebook.data_version
+        self.assertEqual(phonebook.transaction_processor(handler), 'done')
+        self.assertEqual(phonebook.data_version, version + 1)
+        self.assertEqual(db.query('SELECT count(*) AS n FROM phonebook')[0].n, 2)
+
+    def test_slow_request_body(self):
+        '''Test that a write request whose body is slow to arrive doesn't
+        hold up other writes'''
+        class SlowInput(StringIO.StringIO):
+            def read(self, *args):
+                time.sleep(0.5)
+                return StringIO.StringIO.read(self, *args)
+        data = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+        env = {'REQUEST_METHOD':'POST', 'PATH_INFO':'/', 'QUERY_STRING':'',
+               'HTTP_HOST':'0.0.0.0:8080', 'CONTENT_LENGTH':str(len(data)),
+               'wsgi.input':SlowInput(data)}
+        slow = threading.Thread(target=lambda: ''.join(
+            phonebook.app.wsgifunc()(env, lambda status, headers: None)))
+        slow.start()
+        time.sleep(0.1)
+        start = time.time()
+        response = phonebook.app.request("/", method='POST', data=data)
+        elapsed = time.time() - start
+        slow.join()
+        self.assertEqual(response.status, "201 Created")
+        self.assertTrue(elapsed < 0.3, elapsed)
+        self.assertEqual(db.query('SELECT count(*) AS n FROM phonebook')[0].n, 2)
+
+    def test_request_transaction_rollback(self):
+        '''Test that a write request raising an error status leaves no changes'''
+        web.ctx.method, web.ctx.path, web.ctx.headers, web.ctx.data = 'POST', '/batch', [], ''
+        def handler():
+            with db.transaction():
+                id = db.insert('phonebook', surname='Mouse', firstname='Minnie', number='02045679920')
+            phonebook.entries_changed(ids=[id])
+            raise web.badrequest()
+        version = phonebook.data_version
+        self.assertRaises(web.HTTPError, phonebook.transaction_processor, handler)
+        self.assertEqual(phonebook.data_version, version)
+        self.assertEqual(db.query('SELECT count(*) AS n FROM phonebook')[0].n, 0)
+
+    def test_write_behind(self):
+        '''Test that an entry posted with Prefer: respond-async is accepted
+        at once and added to the phonebook by the write log'''
+        log = phonebook.WriteBehindLog('test_write_log.ndjson')
+        phonebook.write_log = log
+        try:
+            data = '{"surname":"Mouse","firstname":"Minnie","number":"02045679920"}'
+            response = phonebook.app.request("/", method='POST', data=data,
+                                             headers={'Prefer':'respond-async'})
+            self.assertEqual(response.status, "202 Accepted")
+            self.assertEqual(response.headers['Preference-Applied'], 'respond-async')
+            tid = self.json_data(response.data)['tid']
+            pending = self.get_loc(response)
+            self.assertTrue(pending.endswith('/pending/%d' % tid))
+
+            # Invalid entries are still rejected straight away
+            response = phonebook.app.request("/", method='POST', data='{"surname":"Mouse"}',
+                                             headers={'Prefer':'respond-async'})
+            self.assertEqual(response.status, "400 Bad Request")
+            response = phonebook.app.request("/", method='POST', headers={'Prefer':'respond-async'},
+                data='{"surname":"Mouse","firstname":"A","number":"020500","address":{"x":1}}')
+            self.assertEqual(response.status, "400 Bad Request")
+
+            log.stop()
+            self.assertEqual(log.stats(), {'pending':0, 'last_tid':tid})
+            self.assertEqual(os.path.getsize('test_write_log.ndjson'), 0)
+        finally:
+            phonebook.write_log = None
+            log.stop()
+            os.remove('test_write_log.ndjson')
+
+        response = phonebook.app.request("/pending/%d" % tid)
+        self.assertEqual(response.status, "303 See Other")
+        response = phonebook.app.request('/' + self.get_loc(response).rsplit('/', 1)[1])
+        self.assertEqual(self.json_data(response.data)['surname'], 'Mouse')
+        response = phonebook.app.request("/pending/%d" % (tid + 1))
+        self.assertEqual(response.status, "404 Not Found")
+
+    def test_write_behind_recovery(self):
+        '''Test that entries left in the write log are added at the next start,
+        except those added before, and a half-written record is dropped'''
+        db.insert('ingested', tid=1, entry_id=1, seqname=False)
+        with open('test_write_log.ndjson', 'wb') as f:
+            for tid, surname in [(1, 'Mouse'), (2, 'Duck'), (3, 'Goofy')]:
+                entry = {'surname':surname, 'firstname':'Minnie', 'number':'02045679920'}
+                f.write(json.dumps({'tid':tid, 'entry':entry}) + '\n')
+            f.write('{"tid":4, "ent')
+        log = phonebook.WriteBehindLog('test_write_log.ndjson')
+        try:
+            log.start()
+            self.assertEqual(log.last_tid, 3)
+            log.stop()
+        finally:
+            os.remove('test_write_log.ndjson')
+        self.assertEqual(sorted(row.surname for row in db.select('phonebook')), ['Duck', 'Goofy'])
+        self.assertEqual([row.tid for row in db.select('ingested', order='tid')], [1, 2, 3])
+
+    def write_log_file(self, records):
+        '''Writes a write log holding records, each a line or an entry'''
+        with open('test_write_log.ndjson', 'wb') as f:
+            for tid, entry in enumerate(records):
+                if isinstance(entry, dict):
+                    entry = json.dumps({'tid':tid + 1, 'entry':entry})
+                f.write(entry + '\n')
+
+    def test_write_behind_rejects(self):
+        '''Test that logged records that can't be added are recorded as
+        failed and don't hold up the entries after them'''
+        minnie = {'surname':'Mouse', 'firstname':'Minnie', 'number':'02045679920'}
+        self.write_log_file([minnie, dict(minnie, address={'x':1}), 'not json',
+                             dict(minnie, firstname='Mickey')])
+        log = phonebook.WriteBehindLog('test_write_log.ndjson')
+        phonebook.write_log = log
+        try:
+            log.start()
+            log.stop()
+            self.assertEqual(os.path.getsize('test_write_log.ndjson'), 0)
+            self.assertEqual(log.stats(), {'pending':0, 'last_tid':4})
+
+            response = phonebook.app.request("/pending/2")
+            self.assertEqual(response.status, "200 OK")
+            self.assertEqual(self.json_data(response.data),
+                             {'tid':2, 'error':phonebook.response_strings['invalid_type']})
+            # Nothing shows which entry the unreadable line held
+            self.assertEqual(phonebook.app.request("/pending/3").status, "404 Not Found")
+            self.assertEqual(phonebook.app.request("/pending/4").status, "303 See Other")
+        finally:
+            phonebook.write_log = None
+            os.remove('test_write_log.ndjson')
+        self.assertEqual([row.firstname for row in db.select('phonebook', order='id')],
+                         ["Minnie", "Mickey"])
+
+    def test_write_behind_compaction(self):
+        '''Test that entries already added are cut from the front of the log'''
+        entries = [{'surname':'Mouse', 'firstname':name, 'number':'02045679920'}
+                   for name in ("Minnie", "Mickey", "Morty")]
+        self.write_log_file(entries)
+        log = phonebook.WriteBehindLog('test_write_log.ndjson')
+        compact_size = phonebook.WRITE_LOG_COMPACT_SIZE
+        phonebook.WRITE_LOG_COMPACT_SIZE = 1
+        try:
+            # As if the drainer had added the first entry
+            with open('test_write_log.ndjson', 'rb') as f:
+                first = len(f.readline())
+                log.size = first + len(f.read())
+            log.file = open('test_write_log.ndjson', 'ab')
+            log.offset = first
+            log.compact()
+            self.assertEqual((log.offset, log.size), (0, os.path.getsize('test_write_log.ndjson')))
+            with open('test_write_log.ndjson', 'rb') as f:
+                self.assertEqual([json.loads(line)['tid'] for line in f], [2, 3])
+            log.file.close()
+        finally:
+            phonebook.WRITE_LOG_COMPACT_SIZE = compact_size
+            os.remove('test_write_log.ndjson')
+
+    def test_write_behind_tracking_limit(self):
+        '''Test that only the most recent tracking ids are remembered'''
+        self.write_log_file([{'surname':'Mouse', 'firstname':name, 'number':'02045679920'}
+                             for name in ("Minnie", "Mickey", "Morty")])
+        log = phonebook.WriteBehindLog('test_write_log.ndjson')
+        phonebook.write_log = log
+        max_tracked = phonebook.MAX_TRACKED_TIDS
+        phonebook.MAX_TRACKED_TIDS = 2
+        try:
+            log.start()
+            log.stop()
+            self.assertEqual([row.tid for row in db.select('ingested', order='tid')], [2, 3])
+            self.assertEqual(phonebook.app.request("/pending/1").status, "404 Not Found")
+            self.assertEqual(phonebook.app.request("/pending/3").status, "303 See Other")
+        finally:
+            phonebook.MAX_TRACKED_TIDS = max_tracked
+            phonebook.write_log = None
+            os.remove('test_write_log.ndjson')
+
 #####################
 ## Utility methods ##
 #####################
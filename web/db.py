@@ -11,7 +11,7 @@ __all__ = [
   "database", 'DB',
 ]
 
-import time
+import time, re, threading, Queue
 try:
     import datetime
 except ImportError:
@@ -21,7 +21,7 @@ try: set
 except NameError:
     from sets import Set as set
     
-from utils import threadeddict, storage, iters, iterbetter, safestr, safeunicode
+from utils import threadeddict, storage, iters, iterbetter, safestr, safeunicode, LRUDict
 
 try:
     # db module can work independent of web.py
@@ -475,6 +475,174 @@ class Transaction:
             self.engine.do_rollback()
             self.ctx.transactions = self.ctx.transactions[:self.transaction_count]
 
+# Statements whose results can be cached, statements that never change
+# data, and writes whose target table is known
+_select_pattern = re.compile(r'\s*SELECT\b', re.I)
+_readonly_pattern = re.compile(r'\s*(SELECT|EXPLAIN|PRAGMA|SAVEPOINT|RELEASE|ROLLBACK|BEGIN|COMMIT|END)\b', re.I)
+_write_pattern = re.compile(r'\s*(?:INSERT|REPLACE|UPDATE|DELETE)(?:\s+OR\s+\w+)?(?:\s+INTO|\s+FROM)?\s+([\w.]+)', re.I)
+_table_alias = r'(?:\s+(?:AS\s+)?(?!(?:JOIN|INNER|LEFT|RIGHT|FULL|CROSS|NATURAL)\b)\w+)?'
+_table_pattern = re.compile(r'\b(?:FROM|JOIN)\s+([\w.]+%s(?:\s*,\s*[\w.]+%s)*)' % (_table_alias, _table_alias), re.I)
+# Quoted identifiers, whose tables can't be told from the statement's text
+_quoted_pattern = re.compile(r'["`\[]')
+
+def _query_tables(query):
+    """
+    Returns the names of the tables a SELECT statement reads, or None if
+    they can't be told: it quotes a name, names a table in another schema,
+    or names no tables.
+
+        >>> sorted(_query_tables('SELECT * FROM foo f, Bar WHERE x IN (SELECT y FROM baz JOIN qux q ON 1)'))
+        ['bar', 'baz', 'foo', 'qux']
+        >>> sorted(_query_tables('SELECT * FROM foo ORDER BY a, b'))
+        ['foo']
+        >>> sorted(_query_tables('SELECT * FROM foo AS f LEFT JOIN bar AS b ON f.id = b.id'))
+        ['bar', 'foo']
+        >>> print _query_tables('SELECT * FROM "foo"')
+        None
+        >>> print _query_tables('SELECT * FROM foo JOIN main.bar ON 1')
+        None
+        >>> print _query_tables('SELECT 1')
+        None
+    """
+    if _quoted_pattern.search(query):
+        return None
+    tables = set()
+    for clause in _table_pattern.findall(query):
+        for item in clause.split(','):
+            tables.add(item.split()[0].lower())
+    if not tables or [table for table in tables if '.' in table]:
+        return None
+    return tables
+
+def _written_table(query):
+    """
+    Returns the name of the table a statement writes, or None if it may
+    write anything.
+
+        >>> _written_table('INSERT INTO Foo (a) VALUES (1)')
+        'foo'
+        >>> _written_table('UPDATE OR IGNORE foo SET a = 1')
+        'foo'
+        >>> print _written_table('DELETE FROM main.foo')
+        None
+        >>> print _written_table('UPDATE "foo" SET a = 1')
+        None
+        >>> print _written_table('CREATE TABLE foo (a)')
+        None
+    """
+    written = _write_pattern.match(query)
+    if written is None or '.' in written.group(1):
+        return None
+    return written.group(1).lower()
+
+class QueryCache:
+    """
+    Results of SELECT statements, keyed by their SQL and parameters and
+    holding at most `maxsize` results, least recently used dropped first.
+    Results are dropped when a table they read from is written.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        # key -> (tables read, rows)
+        self.results = LRUDict(maxsize, self._removed)
+        self.keys_by_table = {}
+        # Bumped when a table is written, so results read while it was
+        # being written are not cached
+        self.versions = {}
+        self.all_version = 0
+        self.hits = self.misses = 0
+        # (views, tables whose writes can change other tables), loaded by
+        # the database when first needed and dropped on schema changes
+        self.schema = None
+
+    def get(self, key):
+        """Returns the cached rows for key, or None."""
+        self.lock.acquire()
+        try:
+            value = self.results.get(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return value[1]
+        finally:
+            self.lock.release()
+
+    def version(self, tables):
+        """Returns a token that changes whenever any of `tables` is written."""
+        self.lock.acquire()
+        try:
+            return (self.all_version,) + tuple([self.versions.get(t, 0) for t in sorted(tables)])
+        finally:
+            self.lock.release()
+
+    def put(self, key, tables, version, rows):
+        """Caches rows read from `tables`, unless they were written since
+        `version` was taken."""
+        self.lock.acquire()
+        try:
+            if (self.all_version,) + tuple([self.versions.get(t, 0) for t in sorted(tables)]) != version:
+                return
+            self.results.put(key, (tables, rows))
+            if key in self.results:
+                for table in tables:
+                    self.keys_by_table.setdefault(table, set()).add(key)
+        finally:
+            self.lock.release()
+
+    def schema_info(self, load):
+        """Returns (views, tables whose writes can change other tables),
+        calling `load` for them if they are not known. `load` returns None
+        when the database can't tell."""
+        self.lock.acquire()
+        try:
+            schema, all_version = self.schema, self.all_version
+        finally:
+            self.lock.release()
+        if schema is None:
+            schema = load()
+            self.lock.acquire()
+            try:
+                # Not kept if the schema changed while it was loading
+                if self.all_version == all_version:
+                    self.schema = schema
+            finally:
+                self.lock.release()
+        return schema
+
+    def invalidate(self, tables):
+        """Drops results read from any of `tables`. A table of None, or
+        one whose writes can change other tables, drops every result."""
+        self.lock.acquire()
+        try:
+            if None in tables or self.schema is None or set(tables) & self.schema[1]:
+                if None in tables:
+                    self.schema = None
+                self.all_version += 1
+                self.results = LRUDict(self.maxsize, self._removed)
+                self.keys_by_table = {}
+                return
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+                for key in list(self.keys_by_table.get(table, ())):
+                    self.results.pop(key)
+        finally:
+            self.lock.release()
+
+    def _removed(self, key, value):
+        # Called by self.results for each result it drops
+        for table in value[0]:
+            keys = self.keys_by_table.get(table)
+            if keys:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_table[table]
+
+    def stats(self):
+        return storage(size=len(self.results), maxsize=self.maxsize,
+                       hits=self.hits, misses=self.misses)
+
 class DB: 
     """Database"""
     def __init__(self, db_module, keywords):
@@ -501,6 +669,13 @@ class DB:
             
         # Pooling can be disabled by passing pooling=False in the keywords.
         self.has_pooling = self.keywords.pop('pooling', True) and self.has_pooling
+
+        # Pass query_cache=N in the keywords to cache the results of up to
+        # N SELECT statements until the tables they read are written.
+        # Results are only cached by databases that can list their views,
+        # triggers and foreign keys (see _query_cache_schema).
+        query_cache = self.keywords.pop('query_cache', None)
+        self.query_cache = query_cache and QueryCache(query_cache) or None
             
     def _getctx(self): 
         if not self._ctx.get('db'):
@@ -511,6 +686,7 @@ class DB:
     def _load_context(self, ctx):
         ctx.dbq_count = 0
         ctx.transactions = [] # stack of transactions
+        ctx.written_tables = set() # tables written since the last commit
         
         if self.has_pooling:
             ctx.db = self._connect_with_pooling(self.keywords)
@@ -527,12 +703,17 @@ class DB:
         def commit(unload=True):
             # do db commit and release the connection if pooling is enabled.            
             ctx.db.commit()
+            # writes are only seen by other connections once committed
+            if ctx.written_tables:
+                self.query_cache.invalidate(ctx.written_tables)
+                ctx.written_tables = set()
             if unload and self.has_pooling:
                 self._unload_context(self._ctx)
                 
         def rollback():
             # do db rollback and release the connection if pooling is enabled.
             ctx.db.rollback()
+            ctx.written_tables = set()
             if self.has_pooling:
                 self._unload_context(self._ctx)
                 
@@ -586,6 +767,9 @@ class DB:
             query, params = self._process_query(sql_query)
             out = cur.execute(query, params)
             b = time.time()
+            if self.query_cache is not None and not _readonly_pattern.match(query):
+                # Schema changes and unrecognized statements drop everything
+                self.ctx.written_tables.add(_written_table(query))
         except:
             if self.printing:
                 print >> debug, 'ERR:', str(sql_query)
@@ -639,6 +823,11 @@ class DB:
             sql_query = reparam(sql_query, vars)
         
         if _test: return sql_query
+
+        if self.query_cache is not None and not self.ctx.transactions:
+            out = self._cached_select(sql_query)
+            if out is not None:
+                return out
         
         db_cursor = self._db_cursor()
         self._db_execute(db_cursor, sql_query)
@@ -661,6 +850,106 @@ class DB:
             self.ctx.commit()
         return out
     
+    def _cached_select(self, sql_query):
+        """
+        Returns the result of a SELECT statement from the query cache,
+        running it and caching its rows on a miss. Returns None for other
+        statements, which are not cached.
+
+            >>> db = database(dbn='sqlite', db=':memory:', query_cache=10)
+            >>> _ = db.query('CREATE TABLE person (id INTEGER PRIMARY KEY, name TEXT)')
+            >>> _ = db.insert('person', name='bob')
+            >>> db.select('person').list()
+            [<Storage {'id': 1, 'name': u'bob'}>]
+            >>> db.select('person')[0].name
+            u'bob'
+            >>> sorted(db.query_cache.stats().items())
+            [('hits', 1), ('maxsize', 10), ('misses', 1), ('size', 1)]
+            >>> _ = db.update('person', where='id = 1', name='joe')
+            >>> db.select('person')[0].name
+            u'joe'
+            >>> with db.transaction():
+            ...     _ = db.insert('person', name='sue')
+            ...     len(db.select('person').list())
+            2
+            >>> len(db.select('person').list())
+            2
+
+        SELECTs whose tables can't be told, and views, are not cached.
+
+            >>> _ = db.query('CREATE VIEW people AS SELECT * FROM person')
+            >>> for q in ['SELECT * FROM "person"', 'SELECT * FROM main.person', 'SELECT * FROM people']:
+            ...     _ = db.query(q).list()
+            >>> db.query_cache.stats().size
+            0
+            >>> _ = db.insert('person', name='ann')
+            >>> [len(db.query(q).list()) for q in ['SELECT * FROM "person"', 'SELECT * FROM main.person', 'SELECT * FROM people']]
+            [3, 3, 3]
+
+        Writes naming a table in another schema drop every result.
+
+            >>> len(db.select('person').list())
+            3
+            >>> _ = db.query("DELETE FROM main.person WHERE name = 'ann'")
+            >>> len(db.select('person').list())
+            2
+
+        So do writes to tables with triggers or foreign keys, which can
+        change other tables.
+
+            >>> _ = db.query('CREATE TABLE log (name TEXT)')
+            >>> _ = db.query('CREATE TRIGGER person_log AFTER INSERT ON person BEGIN INSERT INTO log VALUES (new.name); END')
+            >>> len(db.select('log').list())
+            0
+            >>> _ = db.insert('person', name='tom')
+            >>> len(db.select('log').list())
+            1
+            >>> _ = db.query('PRAGMA foreign_keys = ON')
+            >>> _ = db.query('CREATE TABLE phone (person_id INTEGER REFERENCES person ON DELETE CASCADE)')
+            >>> _ = db.insert('phone', person_id=1)
+            >>> len(db.select('phone').list())
+            1
+            >>> _ = db.delete('person', where='id = 1')
+            >>> len(db.select('phone').list())
+            0
+        """
+        query, params = self._process_query(sql_query)
+        if not _select_pattern.match(query):
+            return None
+        try:
+            key = (query, tuple(params))
+            rows = self.query_cache.get(key)
+        except TypeError:
+            # unhashable parameters
+            return None
+
+        if rows is None:
+            tables = _query_tables(query)
+            if tables is None:
+                return None
+            schema = self.query_cache.schema_info(self._query_cache_schema)
+            if schema is None or tables & schema[0]:
+                return None
+            version = self.query_cache.version(tables)
+            db_cursor = self._db_cursor()
+            self._db_execute(db_cursor, sql_query)
+            names = [x[0] for x in db_cursor.description]
+            rows = [storage(dict(zip(names, x))) for x in db_cursor.fetchall()]
+            self.ctx.commit()
+            self.query_cache.put(key, tables, version, rows)
+
+        # callers get copies, so changing a row doesn't change the cache
+        out = iterbetter(storage(row) for row in rows)
+        out.__len__ = lambda: len(rows)
+        out.list = lambda: [storage(row) for row in rows]
+        return out
+    
+    def _query_cache_schema(self):
+        """Returns the names of views, and of tables whose writes can change
+        other tables, for the query cache. None if they can't be told, in
+        which case nothing is cached."""
+        return None
+
     def select(self, tables, vars=None, what='*', where=None, order=None, group=None, 
                limit=None, offset=None, _test=False): 
         """
@@ -1006,6 +1295,256 @@ def import_driver(drivers, preferred=None):
             pass
     raise ImportError("Unable to import " + " or ".join(drivers))
 
+class SqlitePool:
+    """
+    Long-lived SQLite connections shared by all threads: up to `readers`
+    connections for SELECT statements, opened as they are needed, and one
+    writer connection that a single thread at a time holds from its first
+    other statement until it commits or rolls back.
+
+    With `group_delay` set, commits are grouped: each holder's writes are
+    kept in a savepoint of a transaction shared with other holders, which
+    is committed `group_delay` seconds after the first of them finished,
+    or as soon as `group_size` have. Each holder's commit returns once the
+    shared transaction has been committed, so one sync covers them all.
+    """
+    def __init__(self, connect, readers, group_delay=None, group_size=100):
+        self.connect = connect
+        self.max_readers = readers
+        self.opened = 0
+        self.idle = Queue.Queue()
+        self.lock = threading.Lock()
+        self.writer_lock = threading.Lock()
+        self.writer = None
+        self.group_delay = group_delay
+        self.group_size = group_size
+        # holders' writes in the open shared transaction, guarded by writer_lock
+        self.batch = None
+        self.commits = 0
+
+    def get_reader(self):
+        """Returns an idle reader, opening one if fewer than `readers`
+        are open, otherwise waiting for one to be returned."""
+        try:
+            return self.idle.get_nowait()
+        except Queue.Empty:
+            pass
+        self.lock.acquire()
+        try:
+            can_open = self.opened < self.max_readers
+            if can_open:
+                self.opened += 1
+        finally:
+            self.lock.release()
+        if not can_open:
+            return self.idle.get()
+        try:
+            return self.connect()
+        except:
+            self.lock.acquire()
+            self.opened -= 1
+            self.lock.release()
+            raise
+
+    def put_reader(self, conn):
+        self.idle.put(conn)
+
+    def get_writer(self):
+        """Waits for the writer and returns it."""
+        self.writer_lock.acquire()
+        try:
+            if self.writer is None:
+                self.writer = self.connect()
+                if self.group_delay is not None:
+                    # transactions and savepoints are managed here
+                    self.writer.isolation_level = None
+            if self.group_delay is not None:
+                if self.batch is None:
+                    self._execute('BEGIN')
+                    self.batch = storage(writes=0, done=threading.Event(), error=None)
+                self._execute('SAVEPOINT webpy_group')
+        except:
+            self.writer_lock.release()
+            raise
+        return self.writer
+
+    def commit_writer(self):
+        """Commits the holder's writes and releases the writer. With group
+        commit, returns once a commit including them has finished."""
+        if self.group_delay is None:
+            try:
+                self.writer.commit()
+            except:
+                self.rollback_writer()
+                raise
+            self.commits += 1
+            self.writer_lock.release()
+            return
+
+        try:
+            self._execute('RELEASE webpy_group')
+        except:
+            self.rollback_writer()
+            raise
+        batch = self.batch
+        batch.writes += 1
+        leader = batch.writes == 1
+        if batch.writes >= self.group_size:
+            self._commit_batch()
+        self.writer_lock.release()
+
+        if leader and not batch.done.isSet():
+            # give other holders time to add their writes, then commit
+            batch.done.wait(self.group_delay)
+            self.writer_lock.acquire()
+            try:
+                if self.batch is batch:
+                    self._commit_batch()
+            finally:
+                self.writer_lock.release()
+        batch.done.wait()
+        if batch.error is not None:
+            raise batch.error
+
+    def rollback_writer(self):
+        """Rolls back the holder's writes and releases the writer."""
+        try:
+            if self.group_delay is None:
+                self.writer.rollback()
+                return
+            batch = self.batch
+            try:
+                self._execute('ROLLBACK TO webpy_group')
+                self._execute('RELEASE webpy_group')
+            except Exception, e:
+                # SQLite rolled back the whole transaction, along with
+                # the writes of the other holders in it
+                self.batch = None
+                batch.error = e
+                batch.done.set()
+                try:
+                    self._execute('ROLLBACK')
+                except Exception:
+                    pass
+                return
+            if not batch.writes:
+                self.batch = None
+                self._execute('ROLLBACK')
+        finally:
+            self.writer_lock.release()
+
+    def _commit_batch(self):
+        """Commits the shared transaction. Called holding the writer."""
+        batch, self.batch = self.batch, None
+        try:
+            self._execute('COMMIT')
+            self.commits += 1
+        except Exception, e:
+            batch.error = e
+            try:
+                self._execute('ROLLBACK')
+            except Exception:
+                pass
+        batch.done.set()
+
+    def _execute(self, statement):
+        cursor = self.writer.cursor()
+        cursor.execute(statement)
+        cursor.close()
+
+    def stats(self):
+        return storage(readers=self.opened, idle_readers=self.idle.qsize(),
+                       max_readers=self.max_readers, writer_busy=self.writer_lock.locked(),
+                       commits=self.commits)
+
+class SqlitePoolConnection:
+    """
+    A thread's connection to a `SqlitePool`, used as `ctx.db`. SELECT
+    statements run on a pooled reader, unless this connection holds the
+    writer, and other statements take the writer until commit or rollback.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.writer = None
+
+    def cursor(self):
+        return SqlitePoolCursor(self)
+
+    def hold_writer(self):
+        if self.writer is None:
+            self.writer = self.pool.get_writer()
+        return self.writer
+
+    def commit(self):
+        if self.writer is not None:
+            self.writer = None
+            self.pool.commit_writer()
+
+    def rollback(self):
+        if self.writer is not None:
+            self.writer = None
+            self.pool.rollback_writer()
+
+    def __del__(self):
+        # a thread's state can be cleared mid-transaction, don't keep the
+        # writer from everyone else
+        self.rollback()
+
+class SqlitePoolCursor(object):
+    """
+    Cursor of a `SqlitePoolConnection`. Rows of a SELECT run on a reader
+    are fetched straight away, so the reader can go back to the pool.
+    """
+    def __init__(self, conn):
+        self.conn = conn
+        self.cursor = None
+        self.rows = []
+        self._description = None
+        self._rowcount = -1
+
+    def execute(self, query, params=()):
+        if self.conn.writer is not None or not _select_pattern.match(query):
+            self.cursor = self.conn.hold_writer().cursor()
+            return self.cursor.execute(query, params)
+
+        self.cursor = None
+        reader = self.conn.pool.get_reader()
+        try:
+            cursor = reader.cursor()
+            cursor.execute(query, params)
+            self.rows = cursor.fetchall()
+            self.rows.reverse()
+            self._description = cursor.description
+            self._rowcount = cursor.rowcount
+            cursor.close()
+        finally:
+            self.conn.pool.put_reader(reader)
+        return self
+
+    def fetchone(self):
+        if self.cursor is not None:
+            return self.cursor.fetchone()
+        return self.rows and self.rows.pop() or None
+
+    def fetchall(self):
+        if self.cursor is not None:
+            return self.cursor.fetchall()
+        rows, self.rows = self.rows, []
+        rows.reverse()
+        return rows
+
+    def description(self):
+        if self.cursor is not None:
+            return self.cursor.description
+        return self._description
+    description = property(description)
+
+    def rowcount(self):
+        if self.cursor is not None:
+            return self.cursor.rowcount
+        return self._rowcount
+    rowcount = property(rowcount)
+
 class SqliteDB(DB): 
     def __init__(self, **keywords):
         db = import_driver(["sqlite3", "pysqlite2.dbapi2", "sqlite"], preferred=keywords.pop('driver', None))
@@ -1020,11 +1559,152 @@ class SqliteDB(DB):
         self.paramstyle = db.paramstyle
         keywords['database'] = keywords.pop('db')
         keywords['pooling'] = False # sqlite don't allows connections to be shared by threads
+
+        # PRAGMAs run on every new connection: those of the named profile,
+        # then any given as pragmas={name: value}
+        profile = keywords.pop('profile', None)
+        if profile is not None and profile not in self.profiles:
+            raise ValueError, 'Unknown SQLite profile: %r' % profile
+        pragmas = keywords.pop('pragmas', {})
+        self.pragmas = [(name, value) for name, value in self.profiles.get(profile, [])
+                        if name not in pragmas] + sorted(pragmas.items())
+
+        # Pass pool=N to share N long-lived read connections and a single
+        # writer connection between all threads, instead of connecting per
+        # thread. Not for :memory: databases, which are per connection.
+        readers = keywords.pop('pool', None)
+        # Pass group_commit=<seconds> with a pool to commit the writes of
+        # concurrent requests together, at most that long after the first
+        # of them, or once group_commit_size of them are waiting.
+        group_delay = keywords.pop('group_commit', None)
+        group_size = keywords.pop('group_commit_size', 100)
+
         self.dbname = "sqlite"        
         DB.__init__(self, db, keywords)
 
+        if readers:
+            pool_keywords = dict(self.keywords, check_same_thread=False)
+            self.pool = SqlitePool(lambda: self._connect(pool_keywords), readers,
+                                   group_delay, group_size)
+            self.has_pooling = True
+        # multi-row VALUES lists are supported since SQLite 3.7.11
+        self.supports_multiple_insert = getattr(db, 'sqlite_version_info', (0,)) >= (3, 7, 11)
+
+    # PRAGMAs for each profile accepted by database(dbn='sqlite', profile=...)
+    profiles = {
+        # WAL lets readers continue while a write is in progress and, with
+        # synchronous=NORMAL, only syncs at checkpoints. Up to 256MB is
+        # read through mmap, with a 64MB page cache per connection.
+        'performance': [
+            ('journal_mode', 'WAL'),
+            ('synchronous', 'NORMAL'),
+            ('mmap_size', 256 * 1024 * 1024),
+            ('cache_size', -64 * 1024),
+            ('temp_store', 'MEMORY'),
+            ('busy_timeout', 5000),
+        ],
+    }
+
+    def _connect(self, keywords):
+        """
+        Opens a connection and applies the profile's and given PRAGMAs.
+
+            >>> db = database(dbn='sqlite', db=':memory:', profile='performance',
+            ...               pragmas={'cache_size': -1000})
+            >>> db.query('PRAGMA cache_size')[0].cache_size
+            -1000
+            >>> db.query('PRAGMA temp_store')[0].temp_store
+            2
+            >>> db.query('PRAGMA busy_timeout')[0].timeout
+            5000
+        """
+        conn = DB._connect(self, keywords)
+        cursor = conn.cursor()
+        for name, value in self.pragmas:
+            cursor.execute('PRAGMA %s = %s' % (name, value))
+        cursor.close()
+        return conn
+
+    def _connect_with_pooling(self, keywords):
+        """
+        Returns this thread's connection to the pool.
+
+            >>> import os, tempfile
+            >>> path = tempfile.mktemp()
+            >>> db = database(dbn='sqlite', db=path, pool=2)
+            >>> _ = db.query('CREATE TABLE person (id INTEGER PRIMARY KEY, name TEXT)')
+            >>> with db.transaction():
+            ...     db.insert('person', name='bob')
+            ...     db.pool.stats().writer_busy
+            1
+            True
+            >>> db.select('person').list()
+            [<Storage {'id': 1, 'name': u'bob'}>]
+            >>> sorted(db.pool.stats().items())
+            [('commits', 2), ('idle_readers', 1), ('max_readers', 2), ('readers', 1), ('writer_busy', False)]
+            >>> os.remove(path)
+        """
+        return SqlitePoolConnection(self.pool)
+
+    def transaction(self):
+        """Start a transaction. With a pool, it holds the writer until it ends."""
+        t = DB.transaction(self)
+        if self.has_pooling:
+            self.ctx.db.hold_writer()
+        return t
+
     def _process_insert_query(self, query, tablename, seqname):
         return query, SQLQuery('SELECT last_insert_rowid();')
+
+    def _query_cache_schema(self):
+        """Views, and tables that have triggers or take part in foreign keys"""
+        db_cursor = self._db_cursor()
+        self._db_execute(db_cursor, SQLQuery("SELECT type, name, tbl_name FROM sqlite_master"
+                                             " WHERE type IN ('table', 'view', 'trigger')"))
+        rows = db_cursor.fetchall()
+        views = set([name.lower() for type, name, table in rows if type == 'view'])
+        linked = set(views)
+        for type, name, table in rows:
+            if type == 'trigger':
+                linked.add(table.lower())
+            elif type == 'table':
+                self._db_execute(db_cursor, SQLQuery('PRAGMA foreign_key_list("%s")'
+                                                     % name.replace('"', '""')))
+                for key in db_cursor.fetchall():
+                    # the referenced table's name is the third column
+                    linked.update([name.lower(), key[2].lower()])
+        self.ctx.commit()
+        return views, linked
+
+    # smallest limit on parameters per statement across SQLite versions
+    max_variables = 999
+
+    def multiple_insert(self, tablename, values, seqname=None, _test=False):
+        """
+        Inserts multiple rows, splitting them into as many statements as
+        needed to stay within SQLite's limit on parameters per statement.
+        Wrap the call in a transaction to make it atomic.
+
+            >>> db = database(dbn='sqlite', db=':memory:')
+            >>> _ = db.query('CREATE TABLE person (id INTEGER PRIMARY KEY, name TEXT)')
+            >>> ids = db.multiple_insert('person', [dict(name=str(i)) for i in range(2000)])
+            >>> len(ids), ids[0], ids[-1]
+            (2000, 1, 2000)
+            >>> db.query('SELECT count(*) AS n FROM person')[0].n
+            2000
+        """
+        if _test or not self.supports_multiple_insert or not values:
+            return DB.multiple_insert(self, tablename, values, seqname, _test)
+
+        size = max(1, self.max_variables // len(values[0]))
+        out = []
+        for i in range(0, len(values), size):
+            ids = DB.multiple_insert(self, tablename, values[i:i+size], seqname)
+            if ids is None:
+                out = None
+            elif out is not None:
+                out.extend(ids)
+        return out
     
     def query(self, *a, **kw):
         out = DB.query(self, *a, **kw)
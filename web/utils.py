@@ -11,7 +11,7 @@ __all__ = [
   "rstrips", "lstrips", "strips", 
   "safeunicode", "safestr", "utf8",
   "TimeoutError", "timelimit",
-  "Memoize", "memoize",
+  "Memoize", "memoize", "LRUDict", "LRUMemoize", "lrumemoize",
   "re_compile", "re_subm",
   "group", "uniq", "iterview",
   "IterBetter", "iterbetter",
@@ -32,6 +32,12 @@ __all__ = [
 
 import re, sys, time, threading, itertools, traceback, os
 
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python < 2.7: LRUDict, and so LRUMemoize, can't be used
+    OrderedDict = None
+
 try:
     import subprocess
 except ImportError: 
@@ -506,7 +512,212 @@ class Memoize:
 
 memoize = Memoize
 
-re_compile = memoize(re.compile) #@@ threadsafe?
+class LRUDict:
+    """
+    A dictionary holding at most `maxsize` items, dropping the least
+    recently used to make room. `get` and `put` mark a key as recently
+    used. If given, `on_remove(key, value)` is called for every item that
+    leaves the dictionary, so indexes kept alongside it can be tidied.
+
+    It is not thread-safe: callers sharing one between threads hold their
+    own lock around each use.
+
+        >>> removed = []
+        >>> d = LRUDict(2, on_remove=lambda key, value: removed.append(key))
+        >>> d.put('a', 1)
+        >>> d.put('b', 2)
+        >>> d.get('a')
+        1
+        >>> d.put('c', 3)
+        >>> d.keys(), removed
+        (['a', 'c'], ['b'])
+        >>> d.oldest(), d.peek('a'), d.oldest()
+        ('a', 1, 'a')
+        >>> d.pop('a'), d.pop('a'), 'a' in d, len(d)
+        (1, None, False, 1)
+        >>> d.clear()
+        >>> d.items(), removed
+        ([], ['b', 'a', 'c'])
+    """
+    def __init__(self, maxsize, on_remove=None):
+        if OrderedDict is None:
+            raise ImportError("LRUDict needs collections.OrderedDict (Python 2.7)")
+        self.maxsize = maxsize
+        self.on_remove = on_remove
+        # least recently used first
+        self.data = OrderedDict()
+
+    def get(self, key, default=None):
+        """Returns the value for `key`, marking it recently used."""
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            return default
+        self.data[key] = value
+        return value
+
+    def peek(self, key, default=None):
+        """Returns the value for `key`, leaving its place unchanged."""
+        return self.data.get(key, default)
+
+    def put(self, key, value):
+        """Sets `key` to `value`, dropping the least recently used items
+        while there are more than `maxsize`."""
+        self.pop(key)
+        self.data[key] = value
+        while len(self.data) > self.maxsize:
+            self.pop(self.oldest())
+
+    def pop(self, key, default=None):
+        """Removes `key`, returning its value, or `default` if it is missing."""
+        if key not in self.data:
+            return default
+        value = self.data.pop(key)
+        if self.on_remove is not None:
+            self.on_remove(key, value)
+        return value
+
+    def oldest(self):
+        """Returns the least recently used key."""
+        return next(iter(self.data))
+
+    def clear(self):
+        for key in self.data.keys():
+            self.pop(key)
+
+    def keys(self):
+        return self.data.keys()
+
+    def items(self):
+        """Returns the (key, value) pairs, least recently used first."""
+        return self.data.items()
+
+    def __contains__(self, key):
+        return key in self.data
+
+    def __len__(self):
+        return len(self.data)
+
+class LRUMemoize:
+    """
+    Like `Memoize`, but keeps at most `maxsize` return values, dropping the
+    least recently used, and is safe to call from many threads at once.
+    If `expires` is specified, values are recalculated after `expires` seconds.
+
+    Concurrent calls with the same arguments run the function once: the
+    first caller computes the value and the others wait for it. When a
+    value expires, the first caller to notice recalculates it while other
+    callers keep getting the old value until it is done.
+
+        >>> calls = 0
+        >>> def howmanytimeshaveibeencalled(x):
+        ...     global calls
+        ...     calls += 1
+        ...     return calls
+        >>> fastcalls = lrumemoize(howmanytimeshaveibeencalled, maxsize=2)
+        >>> fastcalls(1), fastcalls(2), fastcalls(1)
+        (1, 2, 1)
+        >>> fastcalls(3)
+        3
+        >>> fastcalls(2)
+        4
+        >>> sorted(fastcalls.stats().items())
+        [('hits', 1), ('maxsize', 2), ('misses', 4), ('size', 2)]
+        >>> fastcalls = lrumemoize(howmanytimeshaveibeencalled, expires=.1)
+        >>> fastcalls(1), fastcalls(1)
+        (5, 5)
+        >>> time.sleep(.2)
+        >>> fastcalls(1)
+        6
+        >>> def slowfunc():
+        ...     time.sleep(.1)
+        ...     return howmanytimeshaveibeencalled(None)
+        >>> fastcalls = lrumemoize(slowfunc)
+        >>> threading.Thread(target=fastcalls).start()
+        >>> time.sleep(.01)
+        >>> fastcalls()
+        7
+        >>> calls
+        7
+
+    It can also be used as a decorator:
+
+        >>> @lrumemoize(maxsize=10)
+        ... def square(x):
+        ...     return x * x
+        >>> square(3)
+        9
+    """
+    def __init__(self, func, maxsize=128, expires=None):
+        self.func = func
+        self.maxsize = maxsize
+        self.expires = expires
+        self.lock = threading.Lock()
+        # key -> (value, time calculated)
+        self.cache = LRUDict(maxsize)
+        # key -> Event set when the call calculating it finishes
+        self.running = {}
+        self.hits = self.misses = 0
+
+    def __call__(self, *args, **keywords):
+        key = (args, tuple(sorted(keywords.items())))
+        while True:
+            self.lock.acquire()
+            try:
+                done = self.running.get(key)
+                if key in self.cache:
+                    value, calculated = self.cache.get(key)
+                    self.hits += 1
+                    stale = self.expires and (time.time() - calculated) > self.expires
+                    if not stale or done is not None:
+                        return value
+                elif done is None:
+                    self.misses += 1
+                if done is None:
+                    done = self.running[key] = threading.Event()
+                    break
+            finally:
+                self.lock.release()
+            # Another thread is calculating the value, wait and look again
+            done.wait()
+
+        try:
+            value = self.func(*args, **keywords)
+            self.lock.acquire()
+            try:
+                self.cache.put(key, (value, time.time()))
+            finally:
+                self.lock.release()
+            return value
+        finally:
+            self.lock.acquire()
+            try:
+                del self.running[key]
+            finally:
+                self.lock.release()
+            done.set()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.cache.clear()
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return storage(hits=self.hits, misses=self.misses,
+                       size=len(self.cache), maxsize=self.maxsize)
+
+def lrumemoize(func=None, maxsize=128, expires=None):
+    """
+    Returns an `LRUMemoize` of `func`, or without `func`, a decorator
+    making one with the given options.
+    """
+    if func is None:
+        return lambda func: LRUMemoize(func, maxsize, expires)
+    return LRUMemoize(func, maxsize, expires)
+
+re_compile = lrumemoize(re.compile, maxsize=1000)
 re_compile.__doc__ = """
 A memoized version of re.compile.
 """